@@ -1,43 +1,105 @@
 
 import os
+import re
+import logging
 import socket
-import paramiko
+import atexit
+import threading
+import asyncio
 from fastmcp import FastMCP
-import numpy as np
-import yaml
-from numpy.typing import NDArray
-import base64
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
 mcp = FastMCP("4Dcamera")
+log = logging.getLogger(__name__)
 
-# Define the server's IP address and port
-host = os.getenv("CAM_HOST") # the address of the server to send the commands
-port = os.getenv("CAM_PORT") # the port to send the commands to
+# Define the server's IP address and port. These are required so fail at
+# start up rather than on the first tool call.
+_HOST = os.environ["CAM_HOST"] # the address of the server to send the commands
+_PORT = int(os.environ["CAM_PORT"]) # the port to send the commands to
+_ADDR = (_HOST, _PORT)
 ip = os.getenv("CAM_IP")
 
+# Matches the Q1 reading in the output of `dsh sensor temp`
+_Q1_TEMP_RE = re.compile(r'Q1[^0-9\-]*(-?\d+\.?\d*)')
+
 '''
 This is a set of tools for communicating with the 4Dcamera
 
 '''
 
 
-def ssh_connect_with_password(hostname, username, password, command):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    
+# Pool of open SSH clients keyed by (hostname, username). Reusing the
+# transport avoids a TCP handshake and key exchange on every call.
+_ssh_pool: dict[tuple, "paramiko.SSHClient"] = {}
+_ssh_lock = threading.RLock()
+
+
+def get_ssh_client(hostname, username, password, jump=None):
+    """ Returns a connected SSH client from the pool. A new client is
+    created if none exists yet or if the pooled transport is no longer
+    active.
+
+    Parameters
+    ----------
+    hostname, username, password : str
+        The host to connect to and the credentials to use.
+    jump : tuple (str, str, str), optional
+        The (hostname, username, password) of a jump host. If given, the
+        connection is tunneled through a direct-tcpip channel on the
+        pooled jump host client.
+    """
+    import paramiko # imported on first use to keep server start up fast
+
+    key = (hostname, username)
+    with _ssh_lock:
+        client = _ssh_pool.get(key)
+        if client is not None:
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return client
+            client.close()
+        sock = None
+        if jump is not None:
+            jump_client = get_ssh_client(*jump)
+            sock = jump_client.get_transport().open_channel(
+                'direct-tcpip', (hostname, 22), (jump[0], 0))
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname, username=username, password=password, sock=sock)
+        client.get_transport().set_keepalive(30)
+        _ssh_pool[key] = client
+        return client
+
+
+@atexit.register
+def close_ssh_clients():
+    """ Close all pooled SSH clients when the server exits."""
+    with _ssh_lock:
+        for client in _ssh_pool.values():
+            client.close()
+        _ssh_pool.clear()
+
+
+def ssh_connect_with_password(hostname, username, password, command, jump=None):
+    import paramiko
+    client = get_ssh_client(hostname, username, password, jump=jump)
     try:
-        client.connect(hostname, username=username, password=password)
         stdin, stdout, stderr = client.exec_command(command)
-        result = stdout.read().decode()
-        print(stdout.read().decode())
-        print(stderr.read().decode())
-        return result
-    finally:
+    except paramiko.SSHException:
+        # The pooled transport died between the liveness check and the
+        # command. Drop it and reconnect once.
         client.close()
+        client = get_ssh_client(hostname, username, password, jump=jump)
+        stdin, stdout, stderr = client.exec_command(command)
+    result = stdout.read().decode()
+    log.debug(result)
+    errors = stderr.read().decode()
+    if errors:
+        log.warning(errors)
+    return result
 
 
 
@@ -47,30 +109,93 @@ def greet_user(username):
     return f'hello {username}'
 
 
-def send_command(content):
+# Replies are read in 64 KB chunks into a 12 MB kernel receive buffer
+_RECV_BUFSIZE = 65536
+_SO_RCVBUF = 12*1024*1024
+
+# One lock per (host, port) so concurrent tool calls to the same
+# endpoint do not interleave their commands.
+_endpoint_locks: dict[tuple, asyncio.Lock] = {}
+
+
+async def _exchange(content):
+    """ Sends one command on a new connection and returns the raw reply.
+    The caller must hold the endpoint lock."""
+    # Set the socket options before connecting so the larger receive
+    # buffer is used for the TCP window negotiated in the handshake.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SO_RCVBUF)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, _ADDR)
+    except OSError:
+        sock.close()
+        raise
+    reader, writer = await asyncio.open_connection(sock=sock, limit=_RECV_BUFSIZE)
+    try:
+        writer.write(content.encode())
+        await writer.drain()
+        writer.write_eof()
+        return await reader.read(-1)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def send_command(content):
     """ This function takes in a string as a command to the 4D Camera. 
+    The connection is opened with asyncio so waiting for the reply does
+    not block the MCP event loop.
+
+    The 4D Camera server reads a command until the client closes its
+    write side and then closes the connection after replying, so a new
+    connection is needed for each command.
+
     Parameters
     ----------
     content : str
         The command to send to the 4D Camera server as a string.
+
+    Returns
+    -------
+    : str
+        The reply from the 4D Camera server.
     """
-    # status_text.delete('1.0', tk.END)
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    print(f"# ============ {s=}")
-    s.connect((host, int(port)))
-    s.sendall(content.encode())
-    s.shutdown(socket.SHUT_WR)
-    while True:
-        data = s.recv(4096)
-        if not data:
-            break
-        print(str(data.decode()))
+    async with _endpoint_locks.setdefault(_ADDR, asyncio.Lock()):
+        reply = await _exchange(content)
+    return reply.decode('utf-8', 'replace')
+
 
-    s.close()
+async def send_commands(contents):
+    """ Sends several commands to the 4D Camera in order. The endpoint is
+    held for the whole sequence so commands from other tool calls cannot
+    be interleaved between them.
+
+    The server only accepts one command per connection so each command
+    still uses its own connection.
+
+    Parameters
+    ----------
+    contents : list of str
+        The commands to send to the 4D Camera server.
+
+    Returns
+    -------
+    : list of str
+        The reply to each command.
+    """
+    replies = []
+    async with _endpoint_locks.setdefault(_ADDR, asyncio.Lock()):
+        for content in contents:
+            reply = await _exchange(content)
+            replies.append(reply.decode('utf-8', 'replace'))
+    return replies
 
 
 @mcp.tool()
-def on_new_dark(mode=2, threshold=0, offset=20):
+async def on_new_dark(mode=2, threshold=0, offset=20):
     """This function acquires a new dark image for the camera. It has 
     inputs that allow you to modify the final image such as a threshold, 
     and offset. 
@@ -89,24 +214,24 @@ def on_new_dark(mode=2, threshold=0, offset=20):
         full Gaussian noise profile to be shown in a uint16 dataset.
     """
     content = f"enabledarkfieldsub {mode} {threshold} {offset}"
-    send_command(content)
+    return await send_command(content)
 
 @mcp.tool()
-def on_resync():
+async def on_resync():
     """The function bound to the Resync GUI button. This will run the syncing routine
     on the camera head which aligns all of the columns. It will also reset the scan number."""
     content = "resync"
-    send_command(content)
+    return await send_command(content)
 
 @mcp.tool()
-def on_power_down():
+async def on_power_down():
     """The function bound to the Power down GUI button. This will run the power down
     script on the camera head effectively shutting down the camera."""
     content = "powerdowncamera"
-    send_command(content)
+    return await send_command(content)
 
 @mcp.tool()
-def on_power_up(confirm=None, set_temperature=None):
+async def on_power_up(confirm=None, set_temperature=None):
     """The function bound to the Power Up GUI button. This will run the power up script
     on the camera head. This will start up the camera so it is ready for operation. If the
     keywords are not supplied then confirmation pop up windws are shown.
@@ -119,16 +244,17 @@ def on_power_up(confirm=None, set_temperature=None):
         Set this to True to skip the confirmation box to set the sensor temperature to 19C after
         powering up. Otherwise, the temperature is set to -10C and cooling fails.
     """
+    # The temperature can only be set once the camera is powered so these
+    # two commands are sent in order rather than concurrently.
+    contents = []
     if confirm:
-        content = "powerupcamera"
-        send_command(content)
-
+        contents.append("powerupcamera")
     if set_temperature:
-        content = f"setsensortemperature 19"
-        send_command(content)
+        contents.append("setsensortemperature 19")
+    return await send_commands(contents)
 
 @mcp.tool()
-def on_set_temperature(temperature=None):
+async def on_set_temperature(temperature=None):
     """The function bound to the Set temperature GUI button. It reads the 
     temperature input from a text box and sets the camera temperautre. If
     the temperature keyword is set then it uses that temperature. The 
@@ -138,35 +264,45 @@ def on_set_temperature(temperature=None):
     else:
         temp = temperature.get() # new temperature in GUI
     content = f"setsensortemperature {temp}"
-    send_command(content)
+    return await send_command(content)
 
 @mcp.tool()
-def on_get_temperature():
+async def on_get_temperature():
     """This reads the temperature from the sensor. Only the Q1 temperature is important. This parses
     the output from the sensor and returns only the needed value in celsius."""
     for_vfdaq = os.getenv('for_vfdaq') # `set for_vfdaq=` or `export for_vfdaq=`
-    command1 = f"echo \"dsh sensor temp\" | sshpass -e ssh -T -o HostKeyAlgorithms=ssh-rsa root@{ip}"
-    rr = ssh_connect_with_password('vfdaq.lbl.gov', 'daquser', for_vfdaq, command1)
-    return(rr)
-    #Q1_temp = rr.stdout.split("\n")[0]
+    for_camera = os.getenv('for_camera') # root password on the camera head
+    missing = [name for name, value in (('for_vfdaq', for_vfdaq), ('for_camera', for_camera))
+               if not value]
+    if missing:
+        raise RuntimeError(f'Set {" and ".join(missing)} in the environment or .env file '
+                           'to read the camera temperature')
+    # vfdaq is a jump host; both connections are pooled
+    jump = ('vfdaq.lbl.gov', 'daquser', for_vfdaq)
+    # paramiko blocks so run it in a worker thread to keep the event loop free
+    rr = await asyncio.to_thread(ssh_connect_with_password, ip, 'root', for_camera,
+                                 'dsh sensor temp', jump=jump)
+    match = _Q1_TEMP_RE.search(rr)
+    if match is None:
+        raise ValueError(f'Q1 temperature not found in sensor output: {rr}')
+    return float(match.group(1))
 
 @mcp.tool()
-def start_stem_scan(width, height, npause=0, nread=1, flyback=300, write=1):
+async def start_stem_scan(width, height, npause=0, nread=1, flyback=300, write=1):
     '''Take a stem scan'''
     command = f"startstemscan {npause} {nread} {width} {height} {flyback} {write}"
-    send_command(command)
+    return await send_command(command)
 
 @mcp.tool()
-def insert_camera():
+async def insert_camera():
     ''' Insert camera into beam path.'''
-    send_command('insertcamera')
+    return await send_command('insertcamera')
 
 
 @mcp.tool()
-def retract_camera():
+async def retract_camera():
     '''Retract camera from beam path.'''
-    send_command('retractcamera')
-
+    return await send_command('retractcamera')
 
 
 if __name__ == "__main__":
@@ -5,24 +5,29 @@ Created on Sun Apr  3 19:55:21 2022
 @author: theisw
 """
 
-def dynamic_dm_script(ptime=20, pwidth=256, pheight=256, emd="no emd file"):
+def dynamic_4D_camera_script(ptime=20, pwidth=256, pheight=256, emd="no emd file", nread=1, rotation=0,
+							  dm4_path=r'C:\Users\VALUEDGATANCUSTOMER\Documents\automation\latest_4Dscan.dm4',
+							  dm4_copy_path=r'C:\Users\VALUEDGATANCUSTOMER\Documents\automation\latest_4Dscan_copy.dm4'):
 	'''
 	print('HARD CODED 256x256')
 	pwidth = 256
 	pheight = 256
 	'''
+	# backslashes must be escaped in DM strings
+	dm4_path = str(dm4_path).replace('\\', '\\\\')
+	dm4_copy_path = str(dm4_copy_path).replace('\\', '\\\\')
 	return f"""// Acquire a 4D camera scan.
 
 string command, ipAddressPlusPort, reply
 TagGroup DLG, DLGItems
 
 // Digiscan user variables
-number rotation = 0 // degree, 0 matches FEI software
+number rotation = {rotation} // degree, 0 matches FEI software
 number width = {pwidth}  // pixel, final 4D scan image is width + 1
 number height = {pheight} // pixel
 
 // 4D Camera user varibales
-number nread = 1 // frames per scan position
+number nread = {nread} // frames per scan position
 number nskip = 0 // number to skip between probe positions
 number nflyback = 300 // typically this is set to 300 (# frames for flyback time)
 
@@ -119,8 +124,8 @@ SetName(image0, "scan" + scan_number)
 SaveAsGatan(image0, "X:\\scan" + scan_number + ".dm4")
 
 // For wtipw7server
-SaveAsGatan(image0, "C:\\\\Users\\\\VALUEDGATANCUSTOMER\\\\Documents\\\\automation\\\\latest_4Dscan.dm4")
-SaveAsGatan(image0, "C:\\\\Users\\\\VALUEDGATANCUSTOMER\\\\Documents\\\\automation\\\\latest_4Dscan_copy.dm4")
+SaveAsGatan(image0, "{dm4_path}")
+SaveAsGatan(image0, "{dm4_copy_path}")
 
 SetPersistentNumberNote("4D_scannum", scan_number+1)
 
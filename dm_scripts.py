@@ -3,50 +3,33 @@
 A function that returns templated gatan scripts to call from python.
 """
 
-def dynamic_4D_camera_script(pwidth=256, pheight=256, emd=None, nread=1, rotation=0):
-    """ Returns a properly formateed script to acquire a 4D-STEM scan
-    using the 4D Camera
-    
-    Parameters
-    ----------
-    pwidth: int
-    The width of the 4D-STEM scan. This is the fast scan direction
-    pheight : int
-    The height of the 4D-STEM scan. This is the slow scan direction
-    emd: bool
-    Deprecated and not used
-    nread:int
-    The number of frames to acquire at each probe position
-    rotation: float
-    The STEM rotation in degrees.
-    
-    Returns
-    -------
-    : str
-    The string with the parameters written in the format of a DM script.
-    
-    """
-    script_text =  f"""// Acquire a 4D camera scan.
+import functools
+import string
+
+# The script text is static apart from a few parameters so the template
+# is built once at import time.
+_4D_CAMERA_TEMPLATE = string.Template("""// Acquire a 4D camera scan.
 
         string command, ipAddressPlusPort, reply
         TagGroup DLG, DLGItems
 
         // Digiscan user variables
-        number rotation = {rotation} // degree, 0 matches FEI software
-        number width = {pwidth}  // pixel, final 4D scan image is width + 1
-        number height = {pheight} // pixel
+        number rotation = ${rotation} // degree, 0 matches FEI software
+        number width = ${pwidth}  // pixel, final 4D scan image is width + 1
+        number height = ${pheight} // pixel
 
         // 4D Camera user varibales
-        number nread = {nread} // frames per scan position
+        number nread = ${nread} // frames per scan position
         number nskip = 0 // number to skip between probe positions
         number nflyback = 300 // typically this is set to 300 (# frames for flyback time)
 
         // Other system variables
         number dataType = 4 // 4 byte data
         number signalIndex = 0
-        number pixelTime= 10 // microseconds, only for HAADF
+        number pixelTime= ${ptime} // microseconds, only for HAADF
         number lineSync = 0 //
 
+        number npause = 0 // hard coded, throws frames away
         number write_to_file = 1 // not implemented; use to fill ram with multiple scans in a row
         Number timeout_s = 10.0 // TCP/IP receive timeout
 
@@ -129,31 +112,41 @@ def dynamic_4D_camera_script(pwidth=256, pheight=256, emd=None, nread=1, rotatio
         // Automatically save data to sync directory
         SaveAsGatan(image0, "X:\\scan" + scan_number + ".dm4")
 
-        // For server to read and return
-        SaveAsGatan(image0, "C:\\\\Users\\\\VALUEDGATANCUSTOMER\\\\Documents\\\\automation\\\\latest_4Dscan.dm4")
+        // For server to read and return. The copy is saved last to show the
+        // first file is complete.
+        SaveAsGatan(image0, "${dm4_path}")
+        SaveAsGatan(image0, "${dm4_copy_path}")
 
         SetPersistentNumberNote("4D_scannum", scan_number+1)
 
         result("4Dcamera scan done\\n")
-        """
-    return script_text
-    
-def dynamic_4D_camera_script(dwell_time=1e-6, pwidth=256, pheight=256, rotation=0):
-    """ Returns a properly formateed script to acquire a SSTEM scan
-    using the HAADF detector.
+        """)
+
+@functools.lru_cache(maxsize=128)
+def dynamic_4D_camera_script(ptime=10e-6, pwidth=256, pheight=256, emd=None, nread=1, rotation=0,
+                             dm4_path=r'C:\Users\VALUEDGATANCUSTOMER\Documents\automation\latest_4Dscan.dm4',
+                             dm4_copy_path=r'C:\Users\VALUEDGATANCUSTOMER\Documents\automation\latest_4Dscan_copy.dm4'):
+    """ Returns a properly formateed script to acquire a 4D-STEM scan
+    using the 4D Camera
     
     Parameters
     ----------
-    dwell_time : float
-    The dwell time in seconds.
+    ptime: float
+    The HAADF pixel dwell time in seconds
     pwidth: int
     The width of the 4D-STEM scan. This is the fast scan direction
     pheight : int
     The height of the 4D-STEM scan. This is the slow scan direction
+    emd: bool
+    Deprecated and not used
     nread:int
     The number of frames to acquire at each probe position
     rotation: float
     The STEM rotation in degrees.
+    dm4_path: str or pathlib.Path
+    Where the server reads the scan from
+    dm4_copy_path: str or pathlib.Path
+    A copy saved after dm4_path to signal the scan is written
     
     Returns
     -------
@@ -161,65 +154,9 @@ def dynamic_4D_camera_script(dwell_time=1e-6, pwidth=256, pheight=256, rotation=
     The string with the parameters written in the format of a DM script.
     
     """
-    script_text =  f"""//Acquire a STEM image
-    // Setup scan parameters
-    // Digiscan
-    number dataType = 4 // 4 byte data
-    number width = {pwidth} // pixel, final 4D scan image is width + 1
-    number height = {pheight} // pixel
-
-    number signalIndex = 0
-    number rotation = {rotation} // degree, 0 matches FEI software
-    number pixelTime= {dwell_time}*1e6 // microseconds
-    number lineSync = 0 //
-
-    //Number DSCreateParameters( Number width, Number height, Number rotation, Number pixelTime, Boolean lineSynchEnabled )
-    number p = DSCreateParameters(width, height, rotation, pixelTime, 0)
-
-    // Connect to HAADF
-    //Boolean DSSetParametersSignal( Number paramID, Number signalIndex, Number dataType, Boolean selected, Number imageID )
-    DSSetParametersSignal(p, signalIndex, 4, 1, 0)
-
-    // Start the acquisition
-    //void DSStartAcquisition( Number paramID, Boolean continuous, Boolean synchronous )
-    // synchronoys = 0 to return immediately allowing 4D camerat to start the scan
-    DSStartAcquisition(p, 0, 0)
-
-    image image0 := GetFrontImage()
-
-    dssetexternalpixelclock(0) // 0 for normal
-    DSDeleteParameters(p)
-
-    // For server to read and return
-    SaveAsGatan(image0, "C:\\\\Users\\\\VALUEDGATANCUSTOMER\\\\Documents\\\\automation\\\\latest_HAADF_scan.dm4")
-
-    result("HAADF scan done\\n")
-    """
-    return script_text
-
-//Acquire a STEM image
-// Setup scan parameters
-// Digiscan
-number dataType = 4 // 4 byte data
-number width = {width} // pixel, final 4D scan image is width + 1
-number height = {height} // pixel
-
-number signalIndex = 0
-number rotation = {rotation} // degree, 0 matches FEI software
-number pixelTime= {dwell_time} // microseconds, only for HAADF
-number lineSync = 0 //
-
-//Number DSCreateParameters( Number width, Number height, Number rotation, Number pixelTime, Boolean lineSynchEnabled )
-number p = DSCreateParameters(width, height, rotation, pixelTime, 0)
-
-// Connect to HAADF
-//Boolean DSSetParametersSignal( Number paramID, Number signalIndex, Number dataType, Boolean selected, Number imageID )
-DSSetParametersSignal(p, signalIndex, 4, 1, 0)
-
-// Start the acquisition
-//void DSStartAcquisition( Number paramID, Boolean continuous, Boolean synchronous )
-// synchronoys = 0 to return immediately allowing 4D camerat to start the scan
-DSStartAcquisition(p, 0, 0)
-
-image image0 := GetFrontImage()
-
+    # backslashes must be escaped in DM strings
+    return _4D_CAMERA_TEMPLATE.substitute(rotation=rotation, pwidth=pwidth,
+                                          pheight=pheight, nread=nread,
+                                          ptime=ptime*1e6,
+                                          dm4_path=str(dm4_path).replace('\\', '\\\\'),
+                                          dm4_copy_path=str(dm4_copy_path).replace('\\', '\\\\'))
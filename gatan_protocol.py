@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+The messages passed between the Gatan server and its clients. These are
+encoded with msgpack using msgspec rather than pickle which is faster for
+the small control messages and cannot execute code when decoded.
+"""
+
+from typing import Any, Optional
+
+import msgspec
+import numpy as np
+
+
+class Request(msgspec.Struct, array_like=True):
+    """A command sent to the Gatan server. This is encoded as a
+    [command, params] array to match the (command, params) tuples used by
+    the clients."""
+    command: str
+    params: Any = None
+
+
+class Reply(msgspec.Struct, array_like=True):
+    """The reply from the Gatan server encoded as a [tag, payload] array."""
+    tag: str
+    payload: Any = None
+
+
+class ScanParams(msgspec.Struct):
+    """The settings for a 4D Camera scan sent with take_and_return_data.
+    Missing fields use the defaults below."""
+    ptime: float = 11e-6 # HAADF dwell time in seconds
+    pwidth: int = 512
+    pheight: int = 512
+    emd: Optional[str] = None
+    rotation: float = 0.0
+    nread: int = 1
+
+
+def _enc_hook(obj):
+    """Encodes the numpy types found in the dm4 tags. Acquired data arrays
+    are not encoded here; they are sent as raw frames after the reply."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise NotImplementedError(f'Cannot encode objects of type {type(obj)}')
+
+
+encoder = msgspec.msgpack.Encoder(enc_hook=_enc_hook)
+request_decoder = msgspec.msgpack.Decoder(Request)
+reply_decoder = msgspec.msgpack.Decoder(Reply)
@@ -6,124 +6,321 @@ Created on Tue Oct  8 14:10:26 2024
 """
 
 import sys
-import pickle
+import argparse
+import importlib
+import gc
+import logging
 import zmq
+import msgspec
+import numpy as np
 import ncempy.io as nio
 import os
-from subprocess import call
+from pathlib import Path
+import subprocess
+import tempfile
 import time
+from watchfiles import watch
 import dm_script
 import mb_script
+from gatan_protocol import Reply, ScanParams, encoder, request_decoder
 
 sys.path.append('C:/Users/VALUEDGATANCUSTOMER/Documents/Maestro')
 from TEAM05_tia_gatan import set_TIA2, set_Gatan  # might need to set path to library
 
-class Multiscan_Server():
-    def __init__(self):
+log = logging.getLogger(__name__)
+
+# O_SHORT_LIVED marks the file temporary on Windows so it stays in the
+# cache instead of being flushed to disk. O_BINARY keeps the fd from also
+# translating the newlines that open() already translates.
+_TEMP_FLAGS = (os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+               | getattr(os, 'O_SHORT_LIVED', 0))
+
+def _write_temp(path, text):
+    """Writes a short lived working file such as a DM script."""
+    with open(os.open(path, _TEMP_FLAGS), 'w') as f:
+        f.write(text)
+
+def _metadata_from_tags(tags):
+    """Picks the calibrations and scan settings sent with each acquisition
+    out of the dm4 tags. The full tag dictionary is only sent on request
+    with the get_alltags command.
+
+    ncempy's fileDM parses the whole tag tree when the file is opened and
+    has no index to seek to a single tag, so these are plain dictionary
+    lookups on tags that are already in memory."""
+    return {'calX': tags.get('.ImageList.2.ImageData.Calibrations.Dimension.1.Scale', 1)*1e-6,
+            'calY': tags.get('.ImageList.2.ImageData.Calibrations.Dimension.2.Scale', 1)*1e-6,
+            '4Dscan number': tags.get('.ImageList.2.ImageTags.4Dcamera Parameters.scan_number', None),
+            'dwell': tags.get('.ImageList.2.ImageTags.DigiScan.Sample Time', 0)*1e-6
+            }
+
+class GatanServer():
+    """The zeroMQ server on the Gatan PC. It acquires 4D Camera scans and
+    moves the beam by running templated scripts in DigitalMicrograph."""
+    def __init__(self, sim=False, port=13579, script_module=dm_script, workdir=None):
+        """
+        Parameters
+        ----------
+        sim : bool
+            Write the scripts but do not run DM or switch the TIA/Gatan robot.
+        port : int
+            The TCP port to listen on.
+        script_module : module
+            The module providing dynamic_4D_camera_script, either dm_script or
+            dm_scripts.
+        workdir : str or pathlib.Path, optional
+            The directory for the DM scripts and the dm4 file returned to the
+            client. Defaults to R:\\gatan_tmp on the RAM disk or a new temporary
+            directory if there is no R: drive.
+        """
         
-        self.SIM = False
+        self.SIM = sim
+        self.script_module = script_module
         self.is_gatan = False
+        self.dm_timeout = 600 # seconds to wait for DM to write the dm4 file
+        self.mb_timeout = 30 # seconds to wait for DM to move the beam
+        self._last_mb = None # the last move beam script written to disk
+        self._px_cache = {} # pixel size for each scan number
         
-        if self.SIM:
-            self.DMSCRIPT = r'4Dcamera_automation_acquireScan_temp.s'
-            self.dm4_filename = 'latest_4Dscan.dm4'
-            self.dm4_filename_copy = 'latest_4Dscan.dm4'
-            self.MBSCRIPT = r'move_beam.s'
-        else:
-            self.DMSCRIPT = r'C:\Users\VALUEDGATANCUSTOMER\Documents\automation\4Dcamera_automation_acquireScan_temp.s'
-            self.dm4_filename = 'C:/Users/VALUEDGATANCUSTOMER/Documents/automation/latest_4Dscan.dm4'
-            self.dm4_filename_copy = 'C:/Users/VALUEDGATANCUSTOMER/Documents/automation/latest_4Dscan_copy.dm4'
-            self.MBSCRIPT = r'C:\Users\VALUEDGATANCUSTOMER\Documents\automation\move_beam.s'
+        if workdir is None:
+            if self.SIM:
+                workdir = '.'
+            elif os.path.isdir('R:/'):
+                workdir = r'R:\gatan_tmp'
+            else:
+                workdir = tempfile.mkdtemp(prefix='gatan_')
+        self.workdir = Path(workdir)
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        log.info('Working directory %s', self.workdir)
+        
+        self.DMSCRIPT = self.workdir / '4Dcamera_automation_acquireScan_temp.s'
+        self.dm4_filename = self.workdir / 'latest_4Dscan.dm4'
+        self.dm4_filename_copy = self.workdir / 'latest_4Dscan_copy.dm4'
+        self.MBSCRIPT = self.workdir / 'move_beam.s'
+        
+        # The DM command lines do not change so build them once
+        self._dm_exe = r'C:\Program Files\Gatan\DigitalMicrograph.exe'
+        self._dm_4d_cmd = [self._dm_exe, '/ef', str(self.DMSCRIPT)]
+        self._dm_mb_cmd = [self._dm_exe, '/ef', str(self.MBSCRIPT)]
         
-        port = 13579
+        if not self.SIM:
+            self._ensure_dm_running()
         
-        context = zmq.Context()
+        context = zmq.Context.instance(io_threads=2)
         self.serverSocket = context.socket(zmq.REP)
+        # Do not hold unsent replies at exit and bound the queued messages
+        self.serverSocket.setsockopt(zmq.LINGER, 0)
+        self.serverSocket.setsockopt(zmq.SNDHWM, 100)
+        self.serverSocket.setsockopt(zmq.RCVHWM, 100)
         self.serverSocket.bind('tcp://*:'+str(port))
-        print('Server Online')
+        # Clients on this PC can skip the loopback TCP stack
+        if zmq.has('ipc'):
+            ipc_path = Path(tempfile.gettempdir()) / f'gatan_server_{port}.ipc'
+            self.serverSocket.bind(f'ipc://{ipc_path}')
+            log.info('Also listening on ipc://%s', ipc_path)
+        log.info('Server Online')
+
+        self._handlers = {'tia_or_gatan': self._h_tia_or_gatan,
+                          'set_gatan': self._h_set_gatan,
+                          'set_tia': self._h_set_tia,
+                          'take_and_return_data': self._h_take_and_return_data,
+                          'scan_4d_sequence': self._h_scan_4d_sequence,
+                          'set_roi': self._h_set_roi,
+                          'move_beam': self._h_move_beam,
+                          'get_alltags': self._h_get_alltags,
+                          'get_pixel_size': self._h_get_pixel_size,
+                          }
+
+        # Collect the youngest generation less often. This is a long running
+        # server and the cyclic collector is also paused while messages are
+        # encoded and decoded below.
+        gc.set_threshold(7000, 10, 10)
+        # encode_into resizes this to the length of each reply
+        self._enc_buf = bytearray()
+
+        poller = zmq.Poller()
+        poller.register(self.serverSocket, zmq.POLLIN)
 
         while True:
             
-            data = self.serverSocket.recv()
-            upd = pickle.loads(data)
-            
-            message = None
-            
-            print(upd[0])
-            
-            if upd[0] == 'tia_or_gatan':
-                message = ('is_gatan', self.is_gatan)
-            elif upd[0] == 'set_gatan':
-                self.is_gatan = self.set_is_gatan(True)
-                message = ('is_gatan', self.is_gatan)
-            elif upd[0] == 'set_tia':
-                self.is_gatan = self.set_is_gatan(False)
-                message = ('is_gatan', self.is_gatan)
-            elif upd[0] == 'take_and_return_data':
-                prev_is_gatan = self.is_gatan
-                if not self.is_gatan:
-                    self.is_gatan = self.set_is_gatan(True)
-                ret = self.take_gatan_data(upd[1])
-                if self.is_gatan != prev_is_gatan:
-                    self.is_gatan = self.set_is_gatan(prev_is_gatan)
-                #message = ('gatan_is_busy', False)
-                message = ('gatan_data', ret)
-            elif upd[0] == 'set_roi':
-                roi = upd[1]
-                message = ('set_roi', roi)
-            elif upd[0] == 'move_beam':
-                print(upd[1][0], upd[1][1])
-                self.move_beam(upd[1][0], upd[1][1])
-                message = ('beam moved', 0)
-            elif upd[0] == 'get_pixel_size':
-                ps = self.get_pixel_size(nn)
-                message = ('pixelSize', ps)
-            else:
-                print(f'unknown command: {upd}')
+            # Wake up periodically so the loop can do other work between requests
+            events = dict(poller.poll(timeout=100))
+            if self.serverSocket not in events:
+                continue
+            data = self.serverSocket.recv(zmq.NOBLOCK)
+            gc.disable()
+            try:
+                req = request_decoder.decode(data)
+            except msgspec.DecodeError as e:
+                # REP must always reply or the socket will not accept the next request
+                self.serverSocket.send(encoder.encode(Reply('error', str(e))))
+                continue
+            finally:
+                gc.enable()
+            log.debug('received command: %s', req.command)
+            handler = self._handlers.get(req.command)
+            try:
+                message = handler(req.params) if handler else self._unknown(req.command)
+            except Exception as e:
+                log.exception('Error executing command %s', req.command)
+                message = ('error', str(e))
+            # Handlers return (tag, payload) followed by any raw data frames
+            tag, payload, *frames = message
 
-            self.serverSocket.send(pickle.dumps(message))
-            print("Idle")
+            # Small replies are encoded into one reused buffer. zmq copies it
+            # so it is safe to overwrite on the next request.
+            gc.disable()
+            try:
+                encoder.encode_into(Reply(tag, payload), self._enc_buf)
+            except (NotImplementedError, TypeError, ValueError) as e:
+                # REP must always reply so send the error without the data
+                log.exception('Error encoding the reply to %s', req.command)
+                encoder.encode_into(Reply('error', str(e)), self._enc_buf)
+                frames = []
+            finally:
+                gc.enable()
+            if frames:
+                self.serverSocket.send(self._enc_buf, zmq.SNDMORE, copy=True)
+                tracker = self.serverSocket.send_multipart(frames, copy=False, track=True)
+                # The data frame is a memory map of the dm4 file. Release it once
+                # zmq has sent it so the file can be deleted for the next acquisition.
+                tracker.wait()
+                frames.clear()
+                message = None
+            else:
+                self.serverSocket.send(self._enc_buf, copy=True)
+            log.debug("Idle")
     
-    def get_pixel_size(nn):
-        return nio.dm.dmReader(f'X:/scan{nn}')['calX']
+    def _h_tia_or_gatan(self, params):
+        return ('is_gatan', self.is_gatan)
+
+    def _h_set_gatan(self, params):
+        self.is_gatan = self.set_is_gatan(True)
+        return ('is_gatan', self.is_gatan)
+
+    def _h_set_tia(self, params):
+        self.is_gatan = self.set_is_gatan(False)
+        return ('is_gatan', self.is_gatan)
+
+    def _h_take_and_return_data(self, params):
+        # Validate the settings before switching the robot
+        if not isinstance(params, ScanParams):
+            params = msgspec.convert(params if isinstance(params, dict) else {}, ScanParams)
+        prev_is_gatan = self.is_gatan
+        if not self.is_gatan:
+            self.is_gatan = self.set_is_gatan(True)
+        data, metadata = self.acquire_4dcamera_scan(params)
+        if self.is_gatan != prev_is_gatan:
+            self.is_gatan = self.set_is_gatan(prev_is_gatan)
+        # The array is sent as its own frame without copying it into the reply
+        data = np.ascontiguousarray(data)
+        header = {'shape': data.shape, 'dtype': str(data.dtype), 'metadata': metadata}
+        return ('gatan_data', header, memoryview(data))
+
+    def _h_scan_4d_sequence(self, params):
+        """set_gatan, take_and_return_data and set_tia in one request. If
+        only the switch back to TIA fails the data is still returned and
+        the error is listed under 'errors' in the reply header."""
+        # Validate the settings before switching the robot
+        params = msgspec.convert(params if isinstance(params, dict) else {}, ScanParams)
+        self.is_gatan = self.set_is_gatan(True)
+        try:
+            reply = self._h_take_and_return_data(params)
+        finally:
+            # leave TIA selected for cross-correlation
+            tia_error = self._select_tia()
+        if tia_error is not None:
+            reply[1]['errors'] = [f'set_tia: {tia_error}']
+        return reply
+
+    def _select_tia(self):
+        """Switch to TIA and return the error message if it fails."""
+        try:
+            self.is_gatan = self.set_is_gatan(False)
+        except Exception as e:
+            log.exception('Could not switch back to TIA')
+            return str(e)
+        return None
+
+    def _h_set_roi(self, params):
+        return ('set_roi', params)
+
+    def _h_move_beam(self, params):
+        log.debug('move beam by %s, %s', params[0], params[1])
+        self.move_beam(params[0], params[1])
+        return ('beam moved', 0)
+
+    def _h_get_alltags(self, params):
+        return ('alltags', self.get_alltags())
+
+    def _h_get_pixel_size(self, params):
+        return ('pixelSize', self.get_pixel_size(params))
+
+    def _unknown(self, command):
+        log.warning('unknown command: %s', command)
+        return ('unknown command', command)
+
+    def get_pixel_size(self, nn):
+        """Reads the pixel size in meters from the scan number nn file on
+        disk. Only the header is read and the result is cached because a
+        finished scan does not change."""
+        ps = self._px_cache.get(nn)
+        if ps is None:
+            with nio.dm.fileDM(f'X:/scan{nn}.dm4') as f1:
+                ps = _metadata_from_tags(f1.allTags)['calX']
+            self._px_cache[nn] = ps
+        return ps
     
+    def get_alltags(self):
+        """Returns all of the tags in the last acquired dm4 file."""
+        with nio.dm.fileDM(self.dm4_filename) as f1:
+            return f1.allTags
+
     def move_beam(self, dX, dY):
         mbs = mb_script.move_beam_dm(dX, dY)
-        print('writing move beam script')
-        with open(self.MBSCRIPT, 'w') as f:
-            f.write(mbs)
+        # The move is relative so DM is always called but the script file
+        # only needs to be written when the shift changes
+        if mbs != self._last_mb:
+            log.debug('writing move beam script')
+            _write_temp(self.MBSCRIPT, mbs)
+            self._last_mb = mbs
         if not self.SIM:
             # call script
-            print('calling move beam script')
-            with open('NUL', 'w') as _:
-                call(f'\"C:\\Program Files\\Gatan\\DigitalMicrograph.exe\" /ef \"{self.MBSCRIPT}\"')
+            log.debug('calling move beam script')
+            proc = self._run_dm_script(self._dm_mb_cmd)
+            try:
+                proc.wait(timeout=self.mb_timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                raise
         
-    def take_gatan_data(self, p):
-        self.call4DCamDMscript(p)
-        dm4_file = nio.dm.dmReader(self.dm4_filename)
-        data = dm4_file['data']
-        with nio.dm.fileDM(self.dm4_filename) as f1:
-            allTags = f1.allTags
-        params = {'alltags': allTags,
-                  'calX': allTags.get('.ImageList.2.ImageData.Calibrations.Dimension.1.Scale', 1)*1e-6,
-                  'calY': allTags.get('.ImageList.2.ImageData.Calibrations.Dimension.2.Scale', 1)*1e-6,
-                  '4Dscan number': allTags.get('.ImageList.2.ImageTags.4Dcamera Parameters.scan_number', None),
-                  'dwell': allTags.get('.ImageList.2.ImageTags.DigiScan.Sample Time', 0)*1e-6
-                  }
-        print("HAADF data shape = {}".format(data.shape))
+    def acquire_4dcamera_scan(self, p):
+        """Acquires a 4D Camera scan and returns the HAADF image and its
+        metadata."""
+        self.call_4dcamera_script(p)
+        # Parse the file once for both the data and the tags. The data is
+        # memory mapped so it is read from the file as it is sent.
+        with nio.dm.fileDM(self.dm4_filename, on_memory=False) as f1:
+            data = f1.getDataset(0)['data']
+            params = _metadata_from_tags(f1.allTags)
+        log.debug("HAADF data shape = %s", data.shape)
         return data, params
 
-    def call4DCamDMscript(self, paramdict):
+    def call_4dcamera_script(self, params):
+        """Writes the 4D Camera script and runs it in DM.
+
+        Parameters
+        ----------
+        params : gatan_protocol.ScanParams
+            The scan settings.
+        """
         try:
-            params = {'ptime': 11e-6, 'pwidth': 512, 'pheight': 512, 'emd':None}
-            if isinstance(paramdict, dict):
-                params.update(paramdict)
-            if params['emd'] is None:
-                params['emd'] = "no emd file"
-            dms = dm_script.dynamic_dm_script(ptime=params['ptime'], pwidth=params['pwidth'], pheight=params['pheight'], emd=params['emd'])
-            print('writing DM script')
-            with open(self.DMSCRIPT, 'w') as f:
-                f.write(dms)
+            dms = self.script_module.dynamic_4D_camera_script(
+                ptime=params.ptime, pwidth=params.pwidth, pheight=params.pheight,
+                emd=params.emd or "no emd file", nread=params.nread, rotation=params.rotation,
+                dm4_path=self.dm4_filename, dm4_copy_path=self.dm4_filename_copy)
+            log.debug('writing DM script')
+            _write_temp(self.DMSCRIPT, dms)
             if not self.SIM:
                 # delete any previous dm4 files
                 if os.path.exists(self.dm4_filename):
@@ -131,16 +328,98 @@ class Multiscan_Server():
                 if os.path.exists(self.dm4_filename_copy):
                     os.remove(self.dm4_filename_copy)
                 # call script
-                print('calling DM script')
-                with open('NUL', 'w') as _:
-                    call(f'\"C:\\Program Files\\Gatan\\DigitalMicrograph.exe\" /ef \"{self.DMSCRIPT}\"')
-                # wait for dm4 file to appear
-                while not os.path.exists(self.dm4_filename_copy):
-                    time.sleep(0.1)
-                print('done')
+                log.debug('calling DM script')
+                proc = self._run_dm_script(self._dm_4d_cmd)
+                # wait for dm4 file to appear while DM runs the script
+                try:
+                    self._wait_dm4_ready(self.dm4_filename_copy, timeout=self.dm_timeout)
+                except TimeoutError:
+                    # do not leave a stuck DM instance behind
+                    if proc.poll() is None:
+                        proc.kill()
+                    raise
+                log.debug('done')
         except:
             raise
 
+    def _ensure_dm_running(self):
+        """Starts DM if it is not already running. DM only runs a single
+        instance so each /ef call hands its script to the resident instance
+        instead of starting DM from scratch."""
+        tasks = subprocess.run(['tasklist', '/FI', 'IMAGENAME eq DigitalMicrograph.exe', '/NH'],
+                               capture_output=True, text=True).stdout
+        if 'DigitalMicrograph.exe' not in tasks:
+            log.info('starting DigitalMicrograph')
+            subprocess.Popen([self._dm_exe], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _run_dm_script(self, cmd):
+        """Starts DM to run a script without waiting for it to finish.
+
+        Parameters
+        ----------
+        cmd : list of str
+            The DM argv built in __init__. The list form avoids quoting the
+            command line.
+
+        Returns
+        -------
+        : subprocess.Popen
+            The DM process.
+        """
+        return subprocess.Popen(cmd,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+
+    def _wait_dm4_ready(self, path, timeout=None):
+        """Blocks until DM has created the file at path and finished writing
+        it. The file is created before DM writes the data so its size must
+        stay the same across two checks 20 ms apart.
+
+        Parameters
+        ----------
+        path : str or pathlib.Path
+            The file to wait for.
+        timeout : float, optional
+            The maximum time to wait in seconds. None waits forever.
+        """
+        path = Path(path)
+        start = time.monotonic()
+        self._wait_for_file(path, timeout=timeout)
+        size = path.stat().st_size
+        while True:
+            time.sleep(0.02)
+            new_size = path.stat().st_size
+            if new_size == size and size > 0:
+                return
+            size = new_size
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'{path} was not finished after {timeout} s')
+
+    def _wait_for_file(self, path, timeout=None):
+        """Blocks until the file at path exists. The directory is watched
+        for changes instead of polling so this returns as soon as DM creates
+        the file.
+
+        Parameters
+        ----------
+        path : str or pathlib.Path
+            The file to wait for.
+        timeout : float, optional
+            The maximum time to wait in seconds. None waits forever.
+        """
+        path = Path(path)
+        if path.exists():
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # The watcher yields an empty set every second so the file can be
+        # rechecked in case it was created before the watcher started.
+        for _ in watch(path.parent, debounce=50, rust_timeout=1000,
+                       yield_on_timeout=True, recursive=False):
+            if path.exists():
+                return
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f'{path} was not created after {timeout} s')
+
     def set_is_gatan(self, ig):
         if not self.SIM:
             if ig:
@@ -152,4 +431,17 @@ class Multiscan_Server():
             return ig
 
 if __name__ == '__main__':
-    ms = Multiscan_Server()
\ No newline at end of file
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', action='store', type=int, default=13579, help='server port')
+    parser.add_argument('--sim', action='store_true', help='do not run DM or the TIA/Gatan robot')
+    parser.add_argument('--scripts', action='store', type=str, default='dm_script',
+                        choices=['dm_script', 'dm_scripts'], help='module with the DM script templates')
+    parser.add_argument('--workdir', action='store', type=str, default=None, help='directory for the DM scripts and dm4 files')
+    
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO)
+    ms = GatanServer(sim=args.sim, port=args.port,
+                     script_module=importlib.import_module(args.scripts),
+                     workdir=args.workdir)
\ No newline at end of file
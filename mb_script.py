@@ -5,8 +5,10 @@ Created on Sun Apr  3 19:55:21 2022
 @author: ajpattison
 """
 
-def move_beam_dm(dX, dY):
-    return f""" // move beam
+import string
+
+# Only the beam shift changes between calls so the template is built once
+_MB_TEMPLATE = string.Template(""" // move beam
     
 image im := GetFrontImage()
 String imName = im.ImageGetName()
@@ -15,8 +17,11 @@ number X, Y, currX, currY
 
 DSGetBeamDSPosition(currX, currY)
 DSCalcImageCoordFromDS(im, currX, currY, X, Y)
-number newX = X+{dX}
-number newY = Y+{dY}
+number newX = X+${dX}
+number newY = Y+${dY}
 DSPositionBeam(im, newX, newY)
-Result("Beam moved by {dX}, {dY}\\n")
-"""
\ No newline at end of file
+Result("Beam moved by ${dX}, ${dY}\\n")
+""")
+
+def move_beam_dm(dX, dY):
+    return _MB_TEMPLATE.substitute(dX=dX, dY=dY)
@@ -10,18 +10,37 @@ the microscope PC and on the Gatan PC.
 """
 
 from pathlib import Path
+import os
+import logging
 import io
 import base64
+import collections
+import contextlib
+import gc
+import hashlib
 import argparse
 import time
 from datetime import datetime, timedelta
 from typing import Any, Optional
 
 import pickle
+from multiprocessing import shared_memory
 import numpy as np
 import numpy.typing as npt
 import zmq
 
+try:
+    import numba
+except ImportError:
+    numba = None # optional. The registration kernels fall back to numpy
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None # optional. The registration FFTs fall back to numpy
+
+from gatan_protocol import Request, ScanParams, encoder, reply_decoder
+
 from fastmcp import FastMCP
 from fastmcp.utilities.types import Image as mcpImage
 
@@ -40,6 +59,7 @@ import h5py
 import mfid
 
 mcp = FastMCP("TEAM05_Controller")
+log = logging.getLogger(__name__)
 
 from PIL import Image as pilImage
 
@@ -63,8 +83,7 @@ def get_metadata():
     A dictionary with lots of different STEM metadata.
     
     """
-    d = {'type': 'get_metadata'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_metadata')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -230,6 +249,21 @@ def acquire_c1a1(WD_x=0.0, WD_y=0.0):
         reply_data = Response['reply_data']
         return reply_data
 
+# Coarse or fine corrector setting for each aberration. C1 and C3 use None.
+_AB_SELECT = {'C1': None,
+              'A1_x': 'coarse',
+              'A1_y': 'coarse',
+              'B2_x': 'coarse',
+              'B2_y': 'coarse',
+              'A2_x': 'coarse',
+              'A2_y': 'coarse',
+              'C3': None,
+              'A3_x': 'coarse',
+              'A3_y': 'coarse',
+              'S3_x': 'coarse',
+              'S3_y': 'coarse',
+              }
+
 @mcp.tool()
 def change_aberrations(ab_values:dict):
     '''
@@ -254,33 +288,67 @@ def change_aberrations(ab_values:dict):
     None.
 
     '''
-    ab_select = {'C1': None,
-                 'A1_x': 'coarse',
-                 'A1_y': 'coarse',
-                 'B2_x': 'coarse',
-                 'B2_y': 'coarse',
-                 'A2_x': 'coarse',
-                 'A2_y': 'coarse',
-                 'C3': None,
-                 'A3_x': 'coarse',
-                 'A3_y': 'coarse',
-                 'S3_x': 'coarse',
-                 'S3_y': 'coarse',
-                 }
-
     C1_defocus_flag = True
     undo = False
     bscomp = False
     
     d = {'type': 'ab_only',
          'ab_values': ab_values,
-         'ab_select': ab_select,
+         'ab_select': _AB_SELECT,
          'C1_defocus_flag': C1_defocus_flag,
          'undo': undo,
          'bscomp': bscomp,
          }
     Response = microscope_client.send_traffic(d)
-    print(Response)
+    log.debug('%r', Response)
+
+@mcp.tool()
+def score_aberration_sweep(ab_values_list:list, metric:str='roughness', dwell:float=2e-6,
+                           shape:tuple=(256,256), ccorr:bool=False):
+    '''
+    Take one STEM image for each set of aberrations and return an image
+    quality metric for each. Each change is relative to the current values
+    and is undone after its image, so the aberrations are unchanged when
+    this returns. Use this to sweep an aberration (e.g. C1 for focus) and
+    pick the best value.
+
+    Parameters
+    ----------
+    ab_values_list : list of dict
+        One dictionary per image of the values by which to change the
+        aberrations, in metres. Keys are as in change_aberrations.
+    metric : str, optional
+        Quality metric. One of 'roughness', 'var', 'normvar', 'std',
+        'normstd' or 'df_slice'. The default is 'roughness'.
+    dwell : float, optional
+        Dwell time in seconds. The default is 2e-6 seconds.
+    shape : tuple of ints, optional
+        Image shape in pixels. The default is (256,256) pixels.
+    ccorr : bool, optional
+        Score only the region that overlaps the reference image set with
+        set_reference_image. The default is False.
+
+    Returns
+    -------
+    : list of float
+        The quality metric of each image in the order of ab_values_list.
+    '''
+    d = {'type': 'ac_batch',
+         'ab_values_list': ab_values_list,
+         'ab_select': _AB_SELECT,
+         'dwell': dwell,
+         'shape': shape,
+         'offset': (0, 0),
+         'metric': metric,
+         'C1_defocus_flag': True,
+         'return_images': False,
+         'bscomp': False,
+         'ccorr': ccorr,
+         }
+    Response = microscope_client.send_traffic(d)
+    if Response is None or Response['reply_data'] is None:
+        raise Exception('Command failed.')
+    return [None if q is None else float(q) for q in Response['reply_data']]
 
 @mcp.tool()
 def set_reference_image(dwell:float=2e-6, shape:tuple=(256,256)):
@@ -336,6 +404,63 @@ def move_stage_delta(dX:float=0, dY:float=0, dZ:float=0, dA:float=0, dB:float=0)
     dPos = {'type':'move_stage', 'dX':dX, 'dY':dY, 'dZ':dZ, 'dA':dA, 'dB':dB}
     microscope_client.send_traffic(dPos)
 
+def _acquire_image_data(dwell:float, shape:tuple):
+    '''
+    Acquire a HAADF-STEM image and return the image array with its
+    calibrations as (image, calx, caly, cal_unit_name).
+    '''
+    offset = (0, 0) # hard coded for now
+    d = {'type': 'image', 'dwell': dwell, 'shape': shape, 'offset': offset}
+    if microscope_client.shared_memory:
+        d['shm'] = True
+    Response = microscope_client.send_traffic(d)
+    if Response is None:
+        raise Exception('Command failed.')
+    (image, calx, caly, cal_unit_name) = Response['reply_data']
+    if isinstance(image, dict):
+        image = _copy_from_shared_memory(image)
+    return (image, calx, caly, cal_unit_name)
+
+# The server owns the shared memory blocks so the client must not unlink
+# them when it exits. Python 3.13 can skip the resource tracker for this.
+_SHM_KWARGS = {'track': False} if sys.version_info >= (3, 13) else {}
+
+def _copy_from_shared_memory(desc:dict):
+    '''
+    Copy an array the server left in shared memory. The server reuses the
+    block for the next image so the array is copied out before closing it.
+    '''
+    shm = shared_memory.SharedMemory(name=desc['shm'], **_SHM_KWARGS)
+    try:
+        view = np.ndarray(desc['shape'], np.dtype(desc['dtype']), buffer=shm.buf)
+        image = view.copy()
+        del view # the block cannot be closed while the view exists
+    finally:
+        shm.close()
+    return image
+
+# The image statistics in one pass over the data rather than one pass each
+# for min, max and std.
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _image_stats(x):
+        x = x.ravel()
+        mn = x[0]
+        mx = x[0]
+        s = 0.0
+        s2 = 0.0
+        for i in numba.prange(x.size):
+            v = x[i]
+            mn = min(mn, v)
+            mx = max(mx, v)
+            s += v
+            s2 += v*v
+        mean = s / x.size
+        return mn, mx, np.sqrt(max(0.0, s2/x.size - mean*mean))
+else:
+    def _image_stats(x):
+        return x.min(), x.max(), x.std()
+
 @mcp.tool()
 def acquire_image(dwell:float=2e-6, shape:tuple =(256,256)):
     '''
@@ -362,16 +487,10 @@ def acquire_image(dwell:float=2e-6, shape:tuple =(256,256)):
         the image minimum, the image maximum, and the image standard deviation).
     '''
     
-    offset = (0, 0) # hard coded for now
-    d = {'type': 'image', 'dwell': dwell, 'shape': shape, 'offset': offset}
-    Response = microscope_client.send_traffic(d)
-    if Response is None:
-        raise Exception('Command failed.')
-    
-    (image, calx, caly, cal_unit_name) = Response['reply_data']
-    image_min = image.min()
-    image_max = image.max()
-    image_std = image.std()
+    (image, calx, caly, cal_unit_name) = _acquire_image_data(dwell, shape)
+    # The image itself stays on disk. Only the path and these statistics
+    # go back through MCP so return them as plain floats.
+    image_min, image_max, image_std = (float(v) for v in _image_stats(image))
     
     new_id = mfid.mfid()
     dir_path = Path('D:/user_data/Claude')
@@ -395,8 +514,7 @@ def get_mag():
         Current magnification.
 
     '''
-    d = {'type': 'get_mag'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_mag')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -414,13 +532,12 @@ def get_convergence_angle():
         STEM convergence angle in radians.
 
     '''
-    d = {'type': 'get_convergence_angle'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_convergence_angle')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
         reply_data = Response['reply_data']
-        print(reply_data)
+        log.debug('%r', reply_data)
         return reply_data
 
 @mcp.tool()
@@ -437,14 +554,33 @@ def get_stage_pos():
         (x position, y position, z position, alpha angle, beta angle)
 
     '''
-    d = {'type': 'get_stage_pos'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_stage_pos')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
         reply_data = Response['reply_data']
         return reply_data
 
+@mcp.tool()
+def get_state():
+    '''
+    Get the magnification, stage position, camera length, camera length
+    index, high tension and defocus in one request. Use this instead of
+    calling the individual getters when several of these are needed.
+
+    Returns
+    -------
+    : dict
+        The keys are mag, stage_pos, camera_length, camera_length_index,
+        voltage and defocus. The units are the same as the individual
+        getters: the stage position (x, y, z, alpha, beta) is in meters
+        and radians, the voltage is in volts and the defocus is in meters.
+    '''
+    Response = microscope_client.state()
+    if Response is None or Response['reply_data'] is None:
+        raise Exception('Command failed.')
+    return Response['reply_data']
+
 @mcp.tool()
 def get_camera_length():
     '''
@@ -458,8 +594,7 @@ def get_camera_length():
         STEM camera length in meters.
 
     '''
-    d = {'type': 'get_camera_length'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_camera_length')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -479,8 +614,7 @@ def get_camera_length_index():
         The STEM camera length index.
 
     '''
-    d = {'type': 'get_camera_length_index'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_camera_length_index')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -522,7 +656,7 @@ def set_diffraction_shift(shift:tuple):
 
     '''
     d = {'type': 'set_diffraction_shift', 'diff_shift':shift}
-    print(d)
+    log.debug('%r', d)
     microscope_client.send_traffic(d)
 
 @mcp.tool()
@@ -535,8 +669,7 @@ def get_diffraction_shift():
     : str
     The X and Y diffraction shifts in radians.
     '''
-    d = {'type': 'get_diffraction_shift'}
-    response = microscope_client.send_traffic(d)
+    response = microscope_client.query('get_diffraction_shift')
     return response
 
 @mcp.tool()
@@ -558,7 +691,7 @@ def set_beam_tilt(tilt:tuple):
     '''
     diff_shift = (-tilt[0], -tilt[1])
     d = {'type': 'set_beam_tilt', 'beam_tilt': tilt, 'diff_shift': diff_shift}
-    print(d)
+    log.debug('%r', d)
     microscope_client.send_traffic(d)
 
 @mcp.tool()
@@ -571,10 +704,8 @@ def get_beam_tilt(tilt:tuple):
     : str
 
     '''
-    d = {'type': 'get_beam_tilt'}
-    print(d)
-    response = microscope_client.send_traffic(d)
-    print(response)
+    response = microscope_client.query('get_beam_tilt')
+    log.debug('%r', response)
     return response
 
 @mcp.tool()
@@ -612,7 +743,7 @@ def open_column_valve():
     '''
     d = {'type': 'open_column_valve'}
     Response = microscope_client.send_traffic(d)
-    print(Response)
+    log.debug('%r', Response)
     return(Response)
    
 @mcp.tool()
@@ -628,9 +759,36 @@ def close_column_valve():
     '''
     d = {'type': 'close_column_valve'}
     Response = microscope_client.send_traffic(d)
-    print(Response)
+    log.debug('%r', Response)
     return(Response)
 
+def _center_pad(im:npt.NDArray, shape:tuple):
+    '''Centers im in a zero array of the given shape. The image is returned
+    as is if it already has that shape.'''
+    if im.shape == tuple(shape):
+        return im
+    p = np.zeros((shape[0], shape[1]), dtype=im.dtype)
+    p[p.shape[0]//2-im.shape[0]//2:p.shape[0]//2-im.shape[0]//2 + im.shape[0],
+      p.shape[1]//2-im.shape[1]//2:p.shape[1]//2-im.shape[1]//2 + im.shape[1]] = im
+    return p
+
+# FFTs for the registration functions. centering registers many images of
+# the same shape so with pyfftw the plans are cached and reused between calls.
+if pyfftw is not None:
+    import pyfftw.interfaces.numpy_fft
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    _FFT_THREADS = os.cpu_count() or 1
+
+    def _rfft2(x):
+        return pyfftw.interfaces.numpy_fft.rfft2(x, threads=_FFT_THREADS)
+
+    def _irfft2(x, s):
+        return pyfftw.interfaces.numpy_fft.irfft2(x, s=s, threads=_FFT_THREADS)
+else:
+    _rfft2 = np.fft.rfft2
+    _irfft2 = np.fft.irfft2
+
 # called by registration
 def cross_correlate(im0:npt.NDArray, im1:npt.NDArray):
     '''
@@ -649,15 +807,25 @@ def cross_correlate(im0:npt.NDArray, im1:npt.NDArray):
      The numpy array returned is the cross-correlation of the two images.
 
     '''
-    p0 = np.zeros((im0.shape[0], im0.shape[1]))
-    p1 = np.zeros((im0.shape[0], im0.shape[1]))
-    p1[p1.shape[0]//2-im1.shape[0]//2:p1.shape[0]//2-im1.shape[0]//2 + im1.shape[0],
-       p1.shape[1]//2-im1.shape[1]//2:p1.shape[1]//2-im1.shape[1]//2 + im1.shape[1]] = im1
-    f0 = np.fft.fft2(im0)
-    f1 = np.fft.fft2(p1)
-    f0 *= np.conj(f1)
-    c = np.fft.ifft2(f0)
-    return np.fft.fftshift(c.real)
+    p1 = _center_pad(im1, im0.shape)
+    # The images are real so the real FFTs do half the work
+    f0 = _rfft2(im0)
+    f1 = _rfft2(p1)
+    # f1 is not needed afterwards so conjugate it in place
+    f0 *= np.conjugate(f1, out=f1)
+    c = _irfft2(f0, s=im0.shape)
+    return np.fft.fftshift(c)
+
+def _peak_offset(corr:npt.NDArray, shape:tuple, pixelSize:float):
+    '''The position of the correlation peak relative to the center of an
+    image of the given shape, scaled by pixelSize. corr is the unshifted
+    correlation from irfft2. The index is split with divmod and moved to
+    where fftshift would put it so the correlation is not copied.'''
+    h, w = corr.shape
+    iy, ix = divmod(int(corr.argmax()), w)
+    iy = (iy + h//2) % h
+    ix = (ix + w//2) % w
+    return ((iy - shape[0]*0.5)*pixelSize, (ix - shape[1]*0.5)*pixelSize)
 
 # called by centering 
 def registration(refImage:npt.NDArray, curImage:npt.NDArray, pixelSize:float):
@@ -682,13 +850,117 @@ def registration(refImage:npt.NDArray, curImage:npt.NDArray, pixelSize:float):
         offset between two images. This is in terms of the pixelSize input.
 
     '''
-    corr = cross_correlate(curImage-curImage.mean(), refImage-refImage.mean())
-    corr_arg = np.array(np.unravel_index(np.argmax(corr), corr.shape))
-    offset = (corr_arg-np.array(refImage.shape)/2)
-    offset_xy = offset*pixelSize
+    # The reference FFT is cached and the current image is mean subtracted
+    # into a reused buffer so no image sized temporaries are made here.
+    corr = _correlate_precomputed(_reference_fft_conj(refImage, curImage.shape), curImage)
+    offset_xy = _peak_offset(corr, refImage.shape, pixelSize)
     #print(offset_xy)
     return offset_xy
 
+# Elementwise kernels for registration. With numba these run in parallel
+# without the temporaries numpy creates. The images come in a few fixed
+# shapes so the kernels are compiled once per shape with the loop bounds
+# as constants.
+_registration_kernels = {}
+
+if numba is not None:
+    def _make_kernels(h, w):
+        wf = w//2 + 1 # width of the real FFT
+
+        @numba.njit(parallel=True, fastmath=True)
+        def subtract_mean(x, out):
+            m = x.mean()
+            for i in numba.prange(h):
+                for j in range(w):
+                    out[i, j] = x[i, j] - m
+            return out
+
+        @numba.njit(parallel=True, fastmath=True)
+        def multiply_inplace(f0, f1):
+            for i in numba.prange(h):
+                for j in range(wf):
+                    f0[i, j] *= f1[i, j]
+
+        return subtract_mean, multiply_inplace
+else:
+    def _subtract_mean(x, out):
+        return np.subtract(x, x.mean(), out=out)
+
+    def _multiply_inplace(f0, f1):
+        np.multiply(f0, f1, out=f0)
+
+    def _make_kernels(h, w):
+        return _subtract_mean, _multiply_inplace
+
+def _kernels_for_shape(shape:tuple):
+    '''The (subtract_mean, multiply_inplace) kernels for images of this shape.'''
+    kernels = _registration_kernels.get(shape)
+    if kernels is None:
+        kernels = _registration_kernels[shape] = _make_kernels(*shape)
+    return kernels
+
+# Conjugate reference FFTs keyed on a hash of the reference image.
+# center_region is often called again with the same reference.
+_ref_fft_cache = collections.OrderedDict()
+_REF_FFT_CACHE_SIZE = 4
+_REF_FFT_CACHE_MAX_BYTES = 16*1024*1024 # larger images are not worth hashing
+
+def _reference_fft_conj(refImage:npt.NDArray, shape:tuple):
+    '''
+    The conjugate FFT of the mean subtracted reference image as used in
+    registration. This can be computed once and reused when registering
+    several images against the same reference. The last few results are
+    cached and returned read only.
+
+    Parameters
+    ----------
+    refImage : numpy.ndarray
+        Reference image.
+    shape : tuple
+        The shape of the images that will be registered.
+    '''
+    refImage = np.ascontiguousarray(refImage)
+    key = None
+    if refImage.nbytes <= _REF_FFT_CACHE_MAX_BYTES:
+        key = (hashlib.blake2b(refImage, digest_size=16).digest(),
+               refImage.dtype.str, refImage.shape, tuple(shape))
+        ref_fft_conj = _ref_fft_cache.get(key)
+        if ref_fft_conj is not None:
+            _ref_fft_cache.move_to_end(key)
+            return ref_fft_conj
+    ref = np.asarray(refImage, dtype=np.float32)
+    ref_fft_conj = np.conj(_rfft2(_center_pad(ref - ref.mean(), shape)))
+    if key is not None:
+        ref_fft_conj.flags.writeable = False
+        _ref_fft_cache[key] = ref_fft_conj
+        if len(_ref_fft_cache) > _REF_FFT_CACHE_SIZE:
+            _ref_fft_cache.popitem(last=False)
+    return ref_fft_conj
+
+# Float32 buffers for the mean subtracted current image keyed on shape
+_registration_scratch = {}
+
+def _correlate_precomputed(ref_fft_conj:npt.NDArray, curImage:npt.NDArray):
+    '''The cross-correlation of curImage with the reference transformed by
+    _reference_fft_conj. Unlike cross_correlate this is not fftshifted.'''
+    subtract_mean, multiply_inplace = _kernels_for_shape(curImage.shape)
+    scratch = _registration_scratch.get(curImage.shape)
+    if scratch is None:
+        scratch = _registration_scratch[curImage.shape] = np.empty(curImage.shape, dtype=np.float32)
+    f0 = _rfft2(subtract_mean(curImage, scratch))
+    multiply_inplace(f0, ref_fft_conj)
+    return _irfft2(f0, s=curImage.shape)
+
+def _registration_precomputed(ref_fft_conj:npt.NDArray, curImage:npt.NDArray, pixelSize:float):
+    '''
+    The same as registration but takes the reference FFT from
+    _reference_fft_conj so only the current image is transformed. The
+    image is kept in the dtype sent by the server (e.g. int16 counts) and
+    converted to float32 for the FFT.
+    '''
+    corr = _correlate_precomputed(ref_fft_conj, curImage)
+    return _peak_offset(corr, curImage.shape, pixelSize)
+
 @mcp.tool()
 def focus_stem_image(df_range:float=500e-9, num_seed_values:int=5,
                      num_samples:int=5, dwell_time:float=3e-6,
@@ -773,7 +1045,7 @@ def focus_stem_image(df_range:float=500e-9, num_seed_values:int=5,
         ab_values[ab_keys[i]] = mm[i] * 1e-9 # convert to meters
 
     beacon_client.ab_only(ab_values)
-    print('Focusing finished.')
+    log.info('Focusing finished.')
 
 #@mcp.tool()
 def focusing(df_range:float=500e-9):
@@ -797,12 +1069,44 @@ def focusing(df_range:float=500e-9):
         A string that the focusing finished.
 
     '''
-    print('call _focusing with df_range = {}'.format(df_range))
+    log.debug('call _focusing with df_range = %s', df_range)
     _focusing(df_range)
-    print('end focusing')
+    log.debug('end focusing')
     return 'Focusing finished.'
     
 
+def _wait_stage_settled(timeout:float=2.0, tol:float=5e-9):
+    '''
+    Wait until the stage stops moving after a move. The server polls the
+    stage position. Servers without the wait_stage_settled command are
+    polled from here with get_stage_pos instead.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        The longest time to wait in seconds.
+    tol : float, optional
+        The largest change between two position reads for the stage to
+        count as settled. This is in meters for x, y, z and radians for alpha.
+
+    Returns
+    -------
+    : bool
+        True if the stage settled before the timeout.
+    '''
+    Response = microscope_client.send_traffic({'type': 'wait_stage_settled', 'timeout': timeout})
+    if Response is not None and Response['error'] is None:
+        return Response['reply_data']
+    end = time.time() + timeout
+    last = get_stage_pos()
+    while time.time() < end:
+        time.sleep(0.05)
+        cur = get_stage_pos()
+        if all(abs(a - b) < tol for a, b in zip(cur[:4], last[:4])):
+            return True
+        last = cur
+    return False
+
 def center_region(reference_image:npt.NDArray, max_distance:float=100e-9, ntries:int=4,
                   image_stage_cal_factor:float=1.0, dwell_search:float=2e-6, size_search:int=256):
     '''
@@ -836,22 +1140,26 @@ def center_region(reference_image:npt.NDArray, max_distance:float=100e-9, ntries
     None.
 
     '''
-    cenetered = False
+    centered = False
+    ref_fft_conj = None
     for ii in range(ntries):
         
-        curImage, pixelSize = acquire_image(dwell_search, size_search)
+        curImage, pixelSize, _, _ = _acquire_image_data(dwell_search, (size_search, size_search))
         
-        offset = registration(reference_image, curImage, pixelSize) # Perform registration
-        print(f'offset = {offset}') # for debugging
+        # The reference is the same for every try so only transform it once
+        if ref_fft_conj is None:
+            ref_fft_conj = _reference_fft_conj(reference_image, curImage.shape)
+        offset = _registration_precomputed(ref_fft_conj, curImage, pixelSize) # Perform registration
+        log.debug('offset = %s', offset)
         dist = np.sqrt(offset[0]**2 + offset[1]**2)
         if dist > max_distance:
             # Move if needed
             # y may need -ve sign depending on which side of the horizontal axis it's on!!! Need to look into this!
             move_stage_delta(dX=offset[0]*image_stage_cal_factor, dY=offset[1]*image_stage_cal_factor) 
-            time.sleep(1)
+            _wait_stage_settled()
         else:
-            print('Region centered on reference image')
-            cenetered = True
+            log.info('Region centered on reference image')
+            centered = True
             break
     
     if not centered:
@@ -872,17 +1180,20 @@ def get_screenshot():
         The image as fastmcp Image from the utilities types module. 
         The format is a JPG.
     '''
-    d = {'type': 'get_screenshot'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_screenshot')
     
     image = Response['reply_data']
-    image.save(r'd:\user_data\claude_image.png')
     original_width, original_height = image.size
     new_size = (original_width//2, original_height//2)
     resized_image = image.resize(new_size, resample=pilImage.LANCZOS)
-    resized_image.save(r'd:\user_data\claude_image2.jpg')
+    # The server already keeps the full PNG. Encode the JPG once in memory
+    # and write the same bytes to disk rather than reading the file back.
+    buf = io.BytesIO()
+    resized_image.convert('RGB').save(buf, format='JPEG', quality=85)
+    jpg = buf.getvalue()
+    Path(r'd:\user_data\claude_image2.jpg').write_bytes(jpg)
     
-    return mcpImage(r'd:\user_data\claude_image2.jpg')
+    return mcpImage(data=jpg, format='jpeg')
 
 @mcp.tool()
 def blank_beam():
@@ -924,8 +1235,7 @@ def get_voltage():
         the high tension.
     
     '''
-    d = {'type': 'get_voltage'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_voltage')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -943,8 +1253,7 @@ def get_stem_rotation_angle():
         The STEM scanning rotation angle in radisns
     
     '''
-    d = {'type': 'get_stem_rotation'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_stem_rotation')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -978,8 +1287,7 @@ def get_defocus():
         Current defocus value of the microscope in meters.
     
     '''
-    d = {'type': 'get_defocus'}
-    Response = microscope_client.send_traffic(d)
+    Response = microscope_client.query('get_defocus')
     if Response['reply_data'] is None:
         raise Exception('Command failed.')
     else:
@@ -1043,25 +1351,113 @@ def acquire_4D_scan(width:int, height:int):
     None.
     
     '''
-    params = {'ptime':11e-6, 'pwidth':width, 'pheight':height, 'emd':None}
-    gatan_client.send_traffic(('set_gatan', 0)) # set gatan for 4D scan
-    gatan_client.send_traffic(('take_and_return_data', params))
-    gatan_client.send_traffic(('set_tia', 0)) # set tia for x-corr
+    params = ScanParams(ptime=11e-6, pwidth=width, pheight=height)
+    # sets gatan for the 4D scan and then sets tia for x-corr in one request
+    gatan_client.send_traffic(('scan_4d_sequence', params))
+
+@contextlib.contextmanager
+def _gc_paused():
+    '''Pause the cyclic garbage collector while a message is encoded or
+    decoded. This makes many small objects that would otherwise trigger a
+    collection partway through.'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def _join_arrays(data, frames):
+    '''Undo the server's _split_arrays by wrapping each frame it refers to
+    in an array without copying it.'''
+    if isinstance(data, dict) and 'ndarray' in data:
+        buf = frames[data['ndarray']].buffer
+        return np.frombuffer(buf, dtype=np.dtype(data['dtype'])).reshape(data['shape'])
+    if isinstance(data, tuple):
+        return tuple(_join_arrays(v, frames) for v in data)
+    return data
+
+class _ReplyUnpickler(pickle.Unpickler):
+    '''Only loads the types the microscope server sends: builtin
+    containers, numpy arrays and scalars and PIL images. Any other global
+    in the pickle is refused so a reply cannot run arbitrary code.'''
+    _ALLOWED = {('builtins', 'dict'), ('builtins', 'list'), ('builtins', 'tuple'),
+                ('builtins', 'set'), ('builtins', 'frozenset'),
+                ('builtins', 'complex'), ('builtins', 'bytearray'),
+                ('numpy', 'ndarray'), ('numpy', 'dtype'),
+                ('numpy.core.multiarray', '_reconstruct'),
+                ('numpy.core.multiarray', 'scalar'),
+                ('numpy.core.numeric', '_frombuffer'),
+                ('numpy._core.multiarray', '_reconstruct'),
+                ('numpy._core.multiarray', 'scalar'),
+                ('numpy._core.numeric', '_frombuffer'),
+                ('PIL.Image', 'Image'),
+                }
+
+    def find_class(self, module, name):
+        if (module, name) not in self._ALLOWED:
+            raise pickle.UnpicklingError(f'refusing to load {module}.{name}')
+        return super().find_class(module, name)
+
+def _safe_loads(data, buffers=None):
+    '''pickle.loads restricted to the types in _ReplyUnpickler.'''
+    return _ReplyUnpickler(io.BytesIO(data), buffers=buffers).load()
+
+def _load_reply(frames):
+    '''
+    Unpickle a reply from the microscope server. The server sends arrays
+    as frames after the pickle. With pickle protocol 5 they are its
+    out-of-band buffers. Older servers replace them in reply_data with
+    headers that point at the frames.
+    '''
+    header = frames[0].buffer
+    if len(frames) > 1 and header[1] < 5: # the pickle protocol
+        reply = _safe_loads(header)
+        reply['reply_data'] = _join_arrays(reply['reply_data'], frames)
+        return reply
+    return _safe_loads(header, buffers=[f.buffer for f in frames[1:]])
+
+# Encoded requests without parameters keyed by (type, encoding). See
+# Microscope_Client.query
+_ENCODED_QUERIES = {}
 
 class Microscope_Client():
     '''Communicates with the server on the microscope PC.'''
     def __init__(self, host='192.168.0.24', port=7001):
+        # A server on this PC can return images through shared memory
+        self.shared_memory = host in ('localhost', '127.0.0.1')
         try:
             # Set timeout in milliseconds
             timeout_ms = 50000  # 5 seconds
-            context = zmq.Context()
-            self.ClientSocket = context.socket(zmq.REQ)
+            # Both clients share one context. The first call creates it
+            # with an I/O thread for each socket.
+            context = zmq.Context.instance(io_threads=2)
+            # DEALER rather than REQ so several requests can be in flight.
+            # The REP server echoes the request id frame sent before the
+            # empty delimiter so replies can be matched to requests.
+            self.ClientSocket = context.socket(zmq.DEALER)
             self.ClientSocket.setsockopt(zmq.RCVTIMEO, timeout_ms)
             self.ClientSocket.setsockopt(zmq.SNDTIMEO, timeout_ms)
+            # Do not block at exit on unsent requests and only queue
+            # requests once the connection to the server is up
+            self.ClientSocket.setsockopt(zmq.LINGER, 0)
+            self.ClientSocket.setsockopt(zmq.IMMEDIATE, 1)
+            # Keep idle connections open between infrequent tool calls.
+            # zmq already sets TCP_NODELAY. Few requests are ever queued.
+            self.ClientSocket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+            self.ClientSocket.setsockopt(zmq.TCP_KEEPALIVE_IDLE, 30)
+            self.ClientSocket.setsockopt(zmq.SNDHWM, 10)
+            self.ClientSocket.setsockopt(zmq.RCVHWM, 10)
             self.ClientSocket.connect(f"tcp://{host}:{port}")
         except ConnectionRefusedError:
-            print('Please start the BEACON server and try again...')
+            log.error('Please start the BEACON server and try again...')
             exit()
+        self._req_id = 0
+        # Requests are pickled until ping finds the server accepts msgpack
+        self.msgpack = False
+        self._state = None # the last get_state response
+        self._state_time = 0.0
     
     def send_traffic(self, message):
         '''
@@ -1077,32 +1473,156 @@ class Microscope_Client():
         : dict or None
             Response from the server. If no repsonse then None.
         '''
-        print(f'Microscope_Client: {message}')
+        log.debug('Microscope_Client: %r', message)
+        self._state = None # the command may change the state
+        return self._exchange(self._encode(message))
+
+    def ping(self):
+        '''
+        Checks the connection and whether the server accepts msgpack
+        encoded requests. Requests after this use msgpack if it does.
+        
+        Returns
+        -------
+        : dict or None
+            Response from the server. If no repsonse then None.
+        '''
+        Response = self._exchange(pickle.dumps({'type': 'ping'}, protocol=4))
+        if Response is not None:
+            self.msgpack = 'msgpack' in (Response['reply_data'] or ())
+        return Response
+
+    def _encode(self, message):
+        '''Encode a request with msgpack if the server accepts it.
+        Otherwise pickle it with protocol 4 so the Python 3.4 server can
+        load it.'''
+        with _gc_paused():
+            if self.msgpack:
+                return encoder.encode(message)
+            return pickle.dumps(message, protocol=4)
+
+    def state(self, max_age=0.1):
+        '''
+        Sends a get_state request. The response is reused for max_age
+        seconds to absorb repeated calls within one agent step. Any
+        request sent with send_traffic or send_many clears it.
+        
+        Parameters
+        ----------
+        max_age : float
+            How long a response can be reused in seconds.
+        
+        Returns
+        -------
+        : dict or None
+            Response from the server. If no repsonse then None.
+        '''
+        now = time.monotonic()
+        if self._state is None or now - self._state_time > max_age:
+            self._state = self.query('get_state')
+            self._state_time = now
+        return self._state
+
+    def query(self, name):
+        '''
+        Sends a request that has no parameters such as get_mag. These
+        requests never change so each is encoded once and reused.
+        
+        Parameters
+        ----------
+        name : str
+            The request type.
+        
+        Returns
+        -------
+        : dict or None
+            Response from the server. If no repsonse then None.
+        '''
+        log.debug('Microscope_Client: %s', name)
+        key = (name, self.msgpack)
+        data = _ENCODED_QUERIES.get(key)
+        if data is None:
+            data = _ENCODED_QUERIES[key] = self._encode({'type': name})
+        return self._exchange(data)
+
+    def send_many(self, messages):
+        '''
+        Sends several messages before waiting for any reply so the round
+        trips overlap. The server still runs them in order. Do not batch
+        image requests to a local server since they share one shared
+        memory block.
+        
+        Parameters
+        ----------
+        messages : list of dict
+            Messages for the server.
+        
+        Returns
+        -------
+        : list of dict or None
+            The response to each message in the same order. None for any
+            message without a response before the timeout.
+        '''
+        log.debug('Microscope_Client: %r', messages)
+        self._state = None
+        return self._exchange_many([self._encode(m) for m in messages])
+
+    def _exchange(self, data):
+        '''Sends an encoded request and returns the unpickled reply.'''
+        return self._exchange_many([data])[0]
+
+    def _exchange_many(self, datas):
+        '''Sends encoded requests and returns the unpickled replies in order.'''
+        ids = []
+        replies = {}
         try:
-            self.ClientSocket.send(pickle.dumps(message))
-            response = pickle.loads(self.ClientSocket.recv())
-            return response
-            
+            for data in datas:
+                self._req_id += 1
+                req_id = self._req_id.to_bytes(8, 'little')
+                ids.append(req_id)
+                self.ClientSocket.send_multipart([req_id, b'', data])
+            pending = set(ids)
+            while pending:
+                # [req_id, b'', pickle, out-of-band array frames...]
+                frames = self.ClientSocket.recv_multipart(copy=False)
+                req_id = frames[0].bytes
+                if req_id not in pending:
+                    continue # a late reply to a request that timed out
+                pending.discard(req_id)
+                with _gc_paused():
+                    replies[req_id] = _load_reply(frames[2:])
         except zmq.Again:
-            print("Timeout occurred")
-            return None
+            log.warning('Timeout occurred')
+        return [replies.get(req_id) for req_id in ids]
 
 class Gatan_Client():
     """Communicates with the server on the Gatan PC. This is currently called
     the multiscan server because it was used to take multiple 4D-STEM scans. 
     We will rename this to a more generic name in the future."""
-    def __init__(self, host='192.168.0.30', port=13579):
+    def __init__(self, host='192.168.0.30', port=13579, endpoint=None):
+        # endpoint overrides host and port, e.g. the server's ipc:// endpoint
+        # when running on the Gatan PC.
         try:
             # Set timeout in milliseconds
             timeout_ms = 50000  # 5 seconds
-            context = zmq.Context()
+            context = zmq.Context.instance(io_threads=2)
             self.ClientSocket = context.socket(zmq.REQ)
             self.ClientSocket.setsockopt(zmq.RCVTIMEO, timeout_ms)
             self.ClientSocket.setsockopt(zmq.SNDTIMEO, timeout_ms)
-            self.ClientSocket.connect(f"tcp://{host}:{port}")
-            print('Connected')
+            # Do not block at exit on unsent requests and only queue
+            # requests once the connection to the server is up
+            self.ClientSocket.setsockopt(zmq.LINGER, 0)
+            self.ClientSocket.setsockopt(zmq.IMMEDIATE, 1)
+            # Keep idle connections open between infrequent tool calls.
+            # zmq already sets TCP_NODELAY. Few requests are ever queued.
+            self.ClientSocket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+            self.ClientSocket.setsockopt(zmq.TCP_KEEPALIVE_IDLE, 30)
+            self.ClientSocket.setsockopt(zmq.SNDHWM, 10)
+            self.ClientSocket.setsockopt(zmq.RCVHWM, 10)
+            self.ClientSocket.connect(endpoint or f"tcp://{host}:{port}")
+            log.info('Connected')
         except ConnectionRefusedError:
-            print('Please start the Gatan (multiscan) server and try again...')
+            log.error('Please start the Gatan (multiscan) server and try again...')
             exit()
         
     def send_traffic(self, message):
@@ -1111,25 +1631,41 @@ class Gatan_Client():
         
         Parameters
         ----------
-        message : dict
-            Message for the server.
+        message : tuple
+            The (command, params) message for the server.
         
         Returns
         -------
-        : dict or None
-            Response from the server. If no repsonse then None.
+        : tuple or None
+            The (tag, payload) response from the server. If no repsonse then None.
         '''
-        print(f'Gatan_Client: {message}')
+        log.debug('Gatan_Client: %r', message)
         try:
-            self.ClientSocket.send(pickle.dumps(message))
-            response = pickle.loads(self.ClientSocket.recv())
-            return response
+            with _gc_paused():
+                request = encoder.encode(Request(*message))
+            self.ClientSocket.send(request)
+            data = self.ClientSocket.recv()
+            with _gc_paused():
+                reply = reply_decoder.decode(data)
+            if self.ClientSocket.getsockopt(zmq.RCVMORE):
+                # Data arrays follow the reply as a raw frame. The reply has the
+                # shape and dtype so the array is allocated and received directly
+                # into it.
+                hdr = reply.payload
+                data = np.empty(hdr['shape'], dtype=hdr['dtype'])
+                self.ClientSocket.recv_into(data)
+                for error in hdr.get('errors', ()):
+                    log.warning('Gatan server: %s', error)
+                return reply.tag, (data, hdr['metadata'])
+            return reply.tag, reply.payload
         except zmq.Again:
-            print("Timeout occurred.")
+            log.warning('Timeout occurred.')
             return None
 
 if __name__ == "__main__":
     # TEAM 0.5 microscope PC connection settings
+    logging.basicConfig(level=logging.INFO)
+
     mhost = '192.168.0.24'
     mport = 7001
     
@@ -1138,9 +1674,8 @@ if __name__ == "__main__":
     beacon_client = BEACON_Client(mhost, mport) # Communicate with BEACON on the microscope PC
 
     # Check the connection
-    d = {'type': 'ping'}
-    Response = microscope_client.send_traffic(d)
-    print(Response['reply_message'])
+    Response = microscope_client.ping()
+    log.info(Response['reply_message'])
 
     # Gatan PC connection settings
     ghost = '192.168.0.30'
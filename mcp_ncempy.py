@@ -6,7 +6,15 @@ Test MCP agent that can load, process, and display data
 """
 
 from pathlib import Path
+import os
+import sys
+import queue
+import secrets
+import threading
+import asyncio
+import functools
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
 from fastmcp import FastMCP
 from datetime import datetime, timedelta
@@ -17,22 +25,61 @@ from pydantic import AnyHttpUrl, BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from requests.exceptions import HTTPError, RequestException
 
+import msgspec
 import ncempy
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm, NoNorm
-import mfid
+from matplotlib.colors import LogNorm, NoNorm, Normalize
+
+try:
+    import numba
+except ImportError:
+    numba = None # optional. The image statistics fall back to numpy
+
+try:
+    import scipy.fft
+    _fft2 = functools.partial(scipy.fft.fft2, workers=-1) # use all cores
+except ImportError:
+    _fft2 = np.fft.fft2
 
 data = {} # a dictionary that holds all the data.
 metadata = {} # a dictionary that holds all the metadata
+# The arrays in data are views of shared memory blocks so other processes,
+# such as the plotter, can read them by name. These are the blocks.
+data_shm = {}
 
 mcp = FastMCP("NCEMPY MCP")
 
+# Largest image side sent to the plotter. Screens are not much larger.
+_MAX_DISPLAY_SIZE = 2048
+
+def _display_image(image):
+    """ Subsample image so neither side is much over _MAX_DISPLAY_SIZE
+    pixels. This keeps large images from being copied into the plotter's
+    shared memory block and drawn at full size."""
+    step = max(1, max(image.shape[:2]) // _MAX_DISPLAY_SIZE)
+    return image[::step, ::step]
+
+# The plotter process does not own the shared memory so it must not unlink
+# it at exit. Python 3.13 can skip the resource tracker for this.
+_SHM_KWARGS = {'track': False} if sys.version_info >= (3, 13) else {}
+
 class ProcessPlotter:
     """ Creates a plot on the MCP server side that can
-    show images and be updated dynamically. """
+    show images and be updated dynamically.
+    
+    Images are copied into shared memory and only a small msgpack
+    message with the block name, shape, dtype and norm goes through the
+    pipe so nothing is pickled. The plotter sends the block name back once
+    it has copied the image out. Two blocks are used in turn and a block
+    is only overwritten after the plotter has copied the last image in
+    it. """
     def __init__(self):
         self.pipe, plotter_pipe = mp.Pipe()
+        self._shm = [None, None] # the blocks images are written to in turn
+        self._next = 0 # index of the block for the next image
+        self._pending = {} # number of images sent in each block not yet copied
+        self._old_shm = [] # replaced blocks the plotter may still be reading
         self.plot_process = mp.Process(target=self._plot_process, args=(plotter_pipe,))
         self.plot_process.start()
         
@@ -40,28 +87,138 @@ class ProcessPlotter:
     def _plot_process(self, pipe):
         self.fig, self.ax = plt.subplots()
         self.ax.set_title("Dynamic Plot")
-        plt.show(block=False) # Non-blocking show
+        self._im = None # the image artist is reused for every update
+        self._queue = queue.Queue()
+        # The pipe is read with a blocking call in a thread. The GUI event
+        # loop only wakes on a timer to pick up what it received.
+        threading.Thread(target=self._receive, args=(pipe,), daemon=True).start()
+        timer = self.fig.canvas.new_timer(interval=50)
+        timer.add_callback(self._update)
+        timer.start()
+        plt.show() # runs until the figure is closed
 
+    def _receive(self, pipe):
+        """ Receive images in the plot process and queue them for _update."""
         while True:
-            if pipe.poll(): # Check for incoming data
-                data = pipe.recv()
-                if data is None: # Signal to close
+            try:
+                msg = msgspec.msgpack.decode(pipe.recv_bytes())
+            except EOFError: # the MCP server went away
+                msg = None
+            if msg is None: # Signal to close
+                self._queue.put(None)
+                return
+            # Copy the image out and tell the MCP server the block can be reused
+            try:
+                shm = shared_memory.SharedMemory(name=msg['shm'], **_SHM_KWARGS)
+            except FileNotFoundError: # the data was deleted before it was shown
+                pipe.send_bytes(msgspec.msgpack.encode(msg['shm']))
+                continue
+            try:
+                view = np.ndarray(msg['shape'], np.dtype(msg['dtype']), buffer=shm.buf)
+                image = view.copy()
+                del view # the block cannot be closed while the view exists
+            finally:
+                shm.close()
+            pipe.send_bytes(msgspec.msgpack.encode(msg['shm']))
+            self._queue.put((image, msg['norm']))
+
+    def _update(self):
+        """ Show the newest queued image. Runs on the GUI timer."""
+        item = None
+        try:
+            while True:
+                item = self._queue.get_nowait()
+                if item is None:
                     plt.close(self.fig)
-                    break
-                self.ax.clear()
-                image = data[0]
-                norm = data[1]
-                self.ax.imshow(image, norm=norm)
-                self.fig.canvas.draw()
-                self.fig.canvas.flush_events() # Update the display
+                    return
+        except queue.Empty:
+            pass
+        if item is not None:
+            self._show(*item)
+            self.fig.canvas.draw_idle()
 
-            plt.pause(0.01) # Small pause to allow events to process
+    def _show(self, image, norm):
+        """ Update the image artist rather than clearing the axes and
+        creating a new one. norm is 'linear' or 'log'."""
+        norm = LogNorm() if norm == 'log' else Normalize()
+        if self._im is None:
+            self._im = self.ax.imshow(image, norm=norm)
+            return
+        if self._im.get_array().shape != image.shape:
+            h, w = image.shape[:2]
+            self._im.set_extent((-0.5, w - 0.5, h - 0.5, -0.5))
+        self._im.set_data(image)
+        self._im.set_norm(norm)
+        self._im.autoscale()
 
-    def plot(self, data):
-        self.pipe.send(data)
+    def _copied(self, name):
+        """ Record that the plotter copied an image out of block name."""
+        n = self._pending.get(name, 0) - 1
+        if n > 0:
+            self._pending[name] = n
+        else:
+            self._pending.pop(name, None)
 
-    def close(self):
-        self.pipe.send(None) # Send signal to close the plot
+    def _drain_acks(self):
+        """ Read the block names the plotter has sent back so far. This
+        also keeps the pipe from filling up and blocking the plotter."""
+        while self.pipe.poll():
+            self._copied(msgspec.msgpack.decode(self.pipe.recv_bytes()))
+
+    def _wait_copied(self, shm, timeout=1.0):
+        """ Wait until the plotter has copied every image sent in shm.
+        Returns False if it does not answer within timeout seconds."""
+        while self._pending.get(shm.name):
+            if not self.pipe.poll(timeout):
+                return False
+            self._copied(msgspec.msgpack.decode(self.pipe.recv_bytes()))
+        return True
+
+    def _send(self, shm, image, norm):
+        msg = {'shm': shm.name, 'shape': image.shape,
+               'dtype': image.dtype.str, 'norm': norm}
+        self.pipe.send_bytes(msgspec.msgpack.encode(msg))
+        self._pending[shm.name] = self._pending.get(shm.name, 0) + 1
+
+    def plot(self, data, shm=None):
+        """ Show an image. data is (image, norm). If image already fills
+        the shared memory block shm the plotter reads it from there and
+        nothing is copied here."""
+        image, norm = data
+        self._drain_acks()
+        if shm is not None:
+            self._send(shm, image, norm)
+            return
+        image = np.ascontiguousarray(image)
+        i = self._next
+        self._next = 1 - i
+        block = self._shm[i]
+        # A block that is too small, or that the plotter has not finished
+        # reading, is replaced rather than overwritten
+        if block is not None and (block.size < image.nbytes or not self._wait_copied(block)):
+            self._old_shm.append(block)
+            block = None
+        if block is None:
+            block = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+            self._shm[i] = block
+        np.ndarray(image.shape, image.dtype, buffer=block.buf)[:] = image
+        self._send(block, image, norm)
+
+    def close(self, timeout=5):
+        """ Close the plot and free the shared memory. A plot process
+        that does not exit within timeout seconds is terminated."""
+        self.pipe.send_bytes(msgspec.msgpack.encode(None)) # Send signal to close the plot
+        self.plot_process.join(timeout)
+        if self.plot_process.is_alive():
+            self.plot_process.terminate()
+            self.plot_process.join(timeout)
+        for shm in self._old_shm + self._shm:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._shm = [None, None]
+        self._old_shm = []
+        self._pending = {}
 
 @mcp.tool()
 def test_this_server(from_llm:str):
@@ -75,7 +232,7 @@ def test_this_server(from_llm:str):
     print(from_llm)
 
 @mcp.tool()
-def load_image(directory:str, file_name:str):
+async def load_image(directory:str, file_name:str):
     """A function that reads a file using ncempy. The image data
     and metadata stays on the server and is stored in two 
     separate dictionaries called data and metadata. Imasge data and
@@ -97,29 +254,93 @@ def load_image(directory:str, file_name:str):
     """
     file_path = Path(directory) / Path(file_name)
     print(f'loading {file_path}')
-    dd = ncempy.read(file_path)
-    md = get_metadata(file_path)
-    file_id = mfid.mfid()[0]
-    data[file_id] = dd['data']
+    # Read in a worker thread so other tool calls are served meanwhile
+    image, shm, md = await asyncio.to_thread(_read_image, file_path)
+    file_id = secrets.token_hex(4)
+    while file_id in data:
+        file_id = secrets.token_hex(4)
+    data[file_id] = image
+    data_shm[file_id] = shm
     metadata[file_id] = md
-    metadata[file_id]['pixel_size'] = dd['pixelSize']
-    metadata[file_id]['pixel_unit'] = dd['pixelUnit']
     return file_id
 
+# The image statistics in one pass over the data rather than one pass each
+# for max, min and std.
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _image_stats(x):
+        x = x.ravel()
+        mn = x[0]
+        mx = x[0]
+        s = 0.0
+        s2 = 0.0
+        for i in numba.prange(x.size):
+            v = x[i]
+            mn = min(mn, v)
+            mx = max(mx, v)
+            s += v
+            s2 += v*v
+        mean = s / x.size
+        return mx, mn, np.sqrt(max(0.0, s2/x.size - mean*mean))
+else:
+    def _image_stats(x):
+        return x.max(), x.min(), x.std()
+
+def _read_image(file_path):
+    """Reads the data and metadata for load_image."""
+    dd = ncempy.read(file_path)
+    md = get_metadata(file_path)
+    md['pixel_size'] = dd['pixelSize']
+    md['pixel_unit'] = dd['pixelUnit']
+    # The data does not change once loaded so the statistics are computed
+    # here once rather than on every calculate_image_statistics call
+    a = dd['data']
+    a_max, a_min, a_std = _image_stats(np.ascontiguousarray(a))
+    md['stats'] = (float(a_max), float(a_min), float(a_std),
+                   a.shape[0], a.shape[1], a.dtype)
+    image, shm = _to_shared(a)
+    return image, shm, md
+
+def _to_shared(arr):
+    """Copy arr into a new shared memory block. Returns an array view of
+    the block and the block."""
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    image = np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)
+    image[:] = arr
+    return image, shm
+
 def get_metadata(file_path):
     """Get metdata for a specific file. This is
     called by load_image.
     
     Only EMD and DM3/4 data is enabled.
     """
-    
+    mtime_ns = file_path.stat().st_mtime_ns
     if file_path.suffix == '.dm4' or file_path.suffix == '.dm3':
-        with ncempy.io.dm.fileDM(file_path) as f0:
-            md = f0.getMetadata(0)
+        md = _read_dm_md(str(file_path), mtime_ns)
     elif file_path.suffix == '.emd':
-        with ncempy.io.emd.fileEMD(file_path) as f0:
-            md = f0.getMetadata(0)
-    return md
+        md = _read_emd_md(str(file_path), mtime_ns)
+    return dict(md) # the cached dict must not be changed by the caller
+
+# Metadata readers cached on the path and modification time. The time is
+# only part of the key so a file that changed on disk is read again.
+@functools.lru_cache(maxsize=256)
+def _read_dm_md(path_str, mtime_ns):
+    with ncempy.io.dm.fileDM(path_str) as f0:
+        return f0.getMetadata(0)
+
+@functools.lru_cache(maxsize=256)
+def _read_emd_md(path_str, mtime_ns):
+    with ncempy.io.emd.fileEMD(path_str) as f0:
+        return f0.getMetadata(0)
+
+@mcp.tool()
+def clear_metadata_cache():
+    """Forget the metadata read from files so it is read from disk again."""
+    _read_dm_md.cache_clear()
+    _read_emd_md.cache_clear()
+    _read_emd_attrs.cache_clear()
 
 @mcp.tool()
 def retrieve_metadata(file_id:str):
@@ -156,8 +377,10 @@ def list_data_files(directory:str):
     : list
     A list of full file paths as strings.
     """
-    dir_path = Path(directory)
-    return [str(ii) for ii in dir_path.glob('*.*')]
+    # scandir gets the entry type with the listing so no Path objects or
+    # extra stat calls are needed
+    with os.scandir(directory) as it:
+        return [entry.path for entry in it if '.' in entry.name and entry.is_file()]
 
 @mcp.tool()
 def calculate_image_statistics(file_id:str):
@@ -176,10 +399,7 @@ def calculate_image_statistics(file_id:str):
     : tuple (float, float, float, int, int, np.dtype)
     A tuple with the maximum, minumum, standard deviation, image shape y, images shape x, and dtype
     """
-    dd = data[file_id]
-    mm = (dd.max(), dd.min(), dd.std(), 
-          dd.shape[0], dd.shape[1], dd.dtype)
-    return mm
+    return metadata[file_id]['stats']
 
 @mcp.tool()
 def plot_data(file_id:str):
@@ -192,12 +412,16 @@ def plot_data(file_id:str):
     The file_id to use to access the data
     """
     print('plotting')
-    image = data[file_id]
+    image = _display_image(data[file_id])
     norm = 'linear'
-    plotter.plot((image, norm))
+    if image.shape == data[file_id].shape:
+        # Small enough to show as is so the plotter reads the data's own block
+        plotter.plot((data[file_id], norm), shm=data_shm[file_id])
+    else:
+        plotter.plot((image, norm))
 
 @mcp.tool()
-def plot_data_fft(file_id:str):
+async def plot_data_fft(file_id:str):
     """This uses matplotlib imshow to plot the 
     fast fourier transform (FFT) of the data.
     This will show up on the server only.
@@ -208,9 +432,17 @@ def plot_data_fft(file_id:str):
     The file_id to use to access the data
     """
     print('plotting fft')
-    image = np.abs(np.fft.fftshift(np.fft.fft2(data[file_id])))
+    image = await asyncio.to_thread(_fft_magnitude, data[file_id])
     norm = 'log'
     plotter.plot((image, norm))
+
+def _fft_magnitude(image):
+    """The centered FFT magnitude of image subsampled for display."""
+    # Single precision is enough for display. scipy.fft then returns complex64
+    # which halves the memory traffic of the transform and the magnitude.
+    ff = _fft2(image.astype(np.float32, copy=False))
+    mag = np.hypot(ff.real, ff.imag, out=np.empty(ff.shape, dtype=np.float32))
+    return _display_image(np.fft.fftshift(mag))
     
 
 @mcp.tool()
@@ -221,7 +453,7 @@ def get_loaded_data():
     -------
     : list
     """
-    return [kk for kk in data.keys()]
+    return list(data)
 
 #@mcp.tool()
 def get_emd_metadata(directory:str, file_name:str):
@@ -241,23 +473,30 @@ def get_emd_metadata(directory:str, file_name:str):
     A dictionary with various metadata
     """
     file_path = Path(directory) / Path(file_name)
+    return dict(_read_emd_attrs(str(file_path), file_path.stat().st_mtime_ns))
+
+@functools.lru_cache(maxsize=256)
+def _read_emd_attrs(path_str, mtime_ns):
+    """The uncached part of get_emd_metadata."""
     md = {}
-    with ncempy.io.emd.fileEMD(file_path) as f0:
+    with ncempy.io.emd.fileEMD(path_str) as f0:
         md.update(f0.microscope.attrs)
         md.update(f0.sample.attrs)
         md.update(f0.user.attrs)
         
         # Get the pixel size and unit
         try:
+            # Each dim is (values, name, units). Only the first two values
+            # are needed for the pixel size.
             dims = f0.get_emddims(f0.list_emds[0])
-            pixel_size_y = dims[0][0][1] - dims[0][0][0]
-            pixel_size_x = dims[1][0][1] - dims[1][0][0]
+            pixel_size_y = float(np.diff(dims[0][0][:2])[0])
+            pixel_size_x = float(np.diff(dims[1][0][:2])[0])
             
             md['pixel_size_y'] = pixel_size_y
             md['pixel_size_x'] = pixel_size_x
             md['dimension_y_name'] = dims[0][1].replace('_', '')
             md['dimension_x_name'] = dims[1][1].replace('_', '')
-            md['pixel_size_y_unit'] = dims[1][2].replace('_', '')
+            md['pixel_size_y_unit'] = dims[0][2].replace('_', '')
             md['pixel_size_x_unit'] = dims[1][2].replace('_', '')
             
             md['data_shape'] = (dims[0][0].shape[0], dims[1][0].shape[0])
@@ -291,15 +530,22 @@ def get_dm_metadata(directory:str, file_name:str, num=0):
     A dictionary with various metadata
     """
     file_path = Path(directory) / Path(file_name)
-    with ncempy.io.dm.fileDM(file_path) as f0:
-        md = f0.getMetadata(0)
-    return md
+    return dict(_read_dm_md(str(file_path), file_path.stat().st_mtime_ns))
 
 @mcp.tool()
 def delete_data_in_memory():
     """This frees all data and metdata in memory."""
-    data = {}
-    metadata = {}
+    # Clear the module dictionaries. Assigning new ones here would only
+    # create local names and free nothing.
+    data.clear()
+    metadata.clear()
+    for shm in data_shm.values():
+        try:
+            shm.close()
+        except BufferError: # an array view is still in use elsewhere
+            pass
+        shm.unlink()
+    data_shm.clear()
 
 if __name__ == "__main__":
     
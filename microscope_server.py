@@ -8,6 +8,8 @@ COM server to get and set various microscope settings.
 @author: Alex Pattison, Peter Ercius, Morgan Wall
 """
 
+import sys
+import io
 import zmq
 import numpy as np
 import pickle
@@ -27,6 +29,154 @@ from PIL import Image, ImageGrab
 from comtypes.client import CreateObject
 from comtypes.safearray import safearray_as_ndarray
 
+# Pickle protocol 5 sends numpy arrays as separate zeroMQ frames without
+# copying them into the pickle. It needs Python 3.8 so the winpython 3.4
+# install on the microscope PC sends a single pickle.
+PICKLE_OOB = sys.version_info >= (3, 8)
+
+# Clients on the same PC can ask for images in shared memory rather than in
+# the reply. This also needs Python 3.8.
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+def send_pickled(sock, obj):
+    """ Pickle obj and send it on the zeroMQ socket. Large buffers such as
+    images are sent out-of-band as extra frames when pickle protocol 5 is
+    available. Clients should load the reply with
+    pickle.loads(frames[0], buffers=frames[1:]).
+
+    Without protocol 5 the arrays in obj['reply_data'] are still sent as
+    extra frames. Each is replaced by a header dict with its frame index,
+    shape and dtype so the pickle does not copy the array.
+    """
+    if PICKLE_OOB:
+        buffers = []
+        header = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        sock.send_multipart([header] + [b.raw() for b in buffers], copy=False)
+    else:
+        frames = []
+        obj = dict(obj, reply_data=_split_arrays(obj['reply_data'], frames))
+        sock.send_multipart([pickle.dumps(obj)] + frames, copy=False)
+
+def _split_arrays(data, frames):
+    """ Replace the arrays in data (an array or a tuple of values) with
+    header dicts and append the array buffers to frames."""
+    if isinstance(data, np.ndarray):
+        arr = np.ascontiguousarray(data)
+        frames.append(arr)
+        return {'ndarray': len(frames), 'shape': arr.shape, 'dtype': arr.dtype.str}
+    if isinstance(data, tuple):
+        return tuple(_split_arrays(v, frames) for v in data)
+    return data
+
+# Requests can also be msgpack encoded when the msgpack package is
+# installed. msgspec needs Python 3.8 so the plain msgpack package is used.
+# Replies stay pickled since they carry numpy arrays and PIL images.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# scipy.fft (pocketfft) has real transforms that can use several threads.
+# It needs scipy 1.4 so numpy.fft is used on older installs.
+try:
+    import scipy.fft as _fft
+    _FFT_KWARGS = {'workers': -1}
+except ImportError:
+    _fft = np.fft
+    _FFT_KWARGS = {}
+
+# numba fuses the per pixel work of the image quality metrics into one
+# pass. The numpy versions below are used when it is not installed.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def _roughness_reduce_numpy(F, kx2, ky2):
+    """ The roughness sum(|F|**2 * k**2) / sum(|F|**2) of the FFT F.
+    kx2 and ky2 are the squared spatial frequencies along each axis."""
+    G2 = F.real**2 + F.imag**2
+    den = G2.sum()
+    return (np.dot(kx2, G2.sum(axis=1)) + np.dot(ky2, G2.sum(axis=0))) / den
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _roughness_reduce(F, kx2, ky2):
+        num = 0.0
+        den = 0.0
+        for i in numba.prange(F.shape[0]):
+            for j in range(F.shape[1]):
+                g = F[i, j].real**2 + F[i, j].imag**2
+                num += g*(kx2[i] + ky2[j])
+                den += g
+        return num / den
+else:
+    _roughness_reduce = _roughness_reduce_numpy
+
+def _mean_var_numpy(a):
+    """ The mean and variance of the array a."""
+    return a.mean(), a.var()
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _mean_var_2d(a):
+        # Two passes in double precision so the variance is as stable as
+        # np.var without the a - mean temporary. The loops index a directly
+        # so strided views such as the corr_cutout region are not copied.
+        mean = 0.0
+        for i in range(a.shape[0]):
+            for j in range(a.shape[1]):
+                mean += a[i, j]
+        mean /= a.size
+        var = 0.0
+        for i in range(a.shape[0]):
+            for j in range(a.shape[1]):
+                d = a[i, j] - mean
+                var += d*d
+        return mean, var / a.size
+
+    def _mean_var(a):
+        if a.ndim != 2:
+            return _mean_var_numpy(a)
+        return _mean_var_2d(a)
+else:
+    _mean_var = _mean_var_numpy
+
+class RequestUnpickler(pickle.Unpickler):
+    """ Only loads the types found in requests: builtin containers and
+    numpy arrays and scalars. Any other global in the pickle is refused
+    so a request from the network cannot run arbitrary code.
+    """
+    ALLOWED = {('builtins', 'dict'), ('builtins', 'list'), ('builtins', 'tuple'),
+               ('builtins', 'set'), ('builtins', 'frozenset'),
+               ('builtins', 'complex'), ('builtins', 'bytearray'),
+               ('numpy', 'ndarray'), ('numpy', 'dtype'),
+               ('numpy.core.multiarray', '_reconstruct'),
+               ('numpy.core.multiarray', 'scalar'),
+               ('numpy.core.numeric', '_frombuffer'),
+               ('numpy._core.multiarray', '_reconstruct'),
+               ('numpy._core.multiarray', 'scalar'),
+               ('numpy._core.numeric', '_frombuffer'),
+               }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED:
+            raise pickle.UnpicklingError('refusing to load {}.{}'.format(module, name))
+        return super(RequestUnpickler, self).find_class(module, name)
+
+def load_request(data):
+    """ Decode a request from either a pickle or msgpack. Pickles from
+    protocol 2 on start with the PROTO opcode 0x80. A msgpack request is a
+    map with at least a type key so it never starts with 0x80. Arrays are
+    decoded as tuples to match what the pickled requests contain.
+    """
+    if msgpack is not None and data[:1] != b'\x80':
+        return msgpack.unpackb(data, raw=False, use_list=False)
+    return RequestUnpickler(io.BytesIO(data)).load()
+
 class CorrectorCommands():
     '''
     Adapted from CorrectorServer.py provided by CEOS, GmbH.
@@ -187,7 +337,8 @@ class MicroscopeControl():
             A PIl img object.
         """
         img = ImageGrab.grab()
-        img.save('C:/microscope_server_screenshot.png')
+        # Fast deflate. Screenshots compress well even at the lowest level.
+        img.save('C:/microscope_server_screenshot.png', compress_level=1)
         return img
     
     def open_column_valve(self):
@@ -322,6 +473,37 @@ class MicroscopeControl():
         self.Stage.GoTo(stageObj, n)
         #print('Stage moved to = {}'.format(self.Stage.Position()))
     
+    def wait_stage_settled(self, timeout=2.0, tol=5e-9, interval=0.05):
+        ''' Wait until the stage stops moving. The position is read every
+        interval seconds until two reads agree to within tol.
+        
+        Parameters
+        ----------
+        timeout : float
+        The longest time to wait in seconds.
+        tol : float
+        The largest change in X, Y, Z (meters) or alpha (radians) between
+        two reads for the stage to count as settled.
+        interval : float
+        The time between reads in seconds.
+        
+        Returns
+        -------
+        : bool
+        True if the stage settled before the timeout.
+        '''
+        end = time.time() + timeout
+        pos = self.Stage.Position
+        last = (pos.X, pos.Y, pos.Z, pos.A)
+        while time.time() < end:
+            time.sleep(interval)
+            pos = self.Stage.Position
+            cur = (pos.X, pos.Y, pos.Z, pos.A)
+            if all(abs(a - b) < tol for a, b in zip(cur, last)):
+                return True
+            last = cur
+        return False
+
     def move_stage_goto(self, X, Y, Z, A, B):
         """Set the stage position to the values input. This moves directly
         to those coordinates. X, Y, Z are in meters and alpha, beta are in 
@@ -583,6 +765,23 @@ class MicroscopeControl():
         md['stem rotation'] = (self.Ill.RotationCenter.X, self.Ill.RotationCenter.Y)
         return md
     
+    def get_state(self):
+        """ Gets the settings that are most often read together so a
+        client can get them in one request.
+        
+        Returns
+        -------
+        : dict
+        The magnification, stage position (X, Y, Z, alpha, beta), camera
+        length, camera length index, high tension and defocus.
+        """
+        return {'mag': self.get_mag(),
+                'stage_pos': self.get_stage_pos(),
+                'camera_length': self.get_camera_length(),
+                'camera_length_index': self.get_camera_length_index(),
+                'voltage': self.get_voltage(),
+                'defocus': self.get_defocus()}
+    
     def get_beam_tilt(self):
         """Get the STEM rotation center which is the beam tilt in radians.
         
@@ -651,6 +850,24 @@ class MicroscopeControl():
         self.Proj.DiffractionShift = _
         
 class MicroscopeServer():
+    # shift scaling factors (ssf, pixels/nm) used by comp_shift_calc
+    _SSF = (
+            ('C1', (0, 0)),
+            ('A1_x', (0, 0)),
+            ('A1_y', (0, 0)),
+            ('B2_x', (2/400, 0/400)),
+            ('B2_y', (3/400, -1/400)),
+            ('A2_x', (-5/400, -1/400)),
+            ('A2_y', (-7/400, -7/400)),
+            ('C3', (0, 0)),
+            ('A3_x', (-16/400, -4/400)),
+            ('A3_y', (2/400, -24/400)),
+            ('S3_x', (5/1000, 1/1000)),
+            ('S3_y', (0/1000, 5/1000)),
+            )
+    _SSF_INDEX = dict((name, i) for i, (name, _) in enumerate(_SSF))
+    _SSF_MATRIX = np.array([ssf for _, ssf in _SSF], dtype=np.float64)
+
     def __init__(self, port, rpchost=None, rpcport=None, SIM=False, TEST=False, TIA=True, CEOS=True):
         """  A server that accepts strings. Each string is treated
         as a command to set or get microscope settings or enact
@@ -714,6 +931,19 @@ class MicroscopeServer():
         self.logger.info('Server Online on port {}'.format(port))
 
         self.refImage = None
+        self._ref_fft_cache = {} # conjugate FFTs of reference images for corr_cutout
+        self._roughness_cache = {} # window and frequencies for each image shape
+
+        # Quality metric dispatch dictionary for metric_func
+        self._metric_handlers = {
+            'df_slice': self._metric_df_slice,
+            'std': np.std,
+            'normstd': self._metric_normstd,
+            'var': np.var,
+            'normvar': self._metric_normvar,
+            'roughness': self._metric_roughness,
+        }
+        self._shm = None # shared memory block for images sent to local clients
 
         # Command dispatch dictionary
         self.command_handlers = {
@@ -721,6 +951,7 @@ class MicroscopeServer():
             'c1a1': self._handle_c1a1,
             'tableau': self._handle_tableau,
             'ac': self._handle_ac,
+            'ac_batch': self._handle_ac_batch,
             'ab_only': self._handle_ab_only,
             'ref': self._handle_ref,
             'image': self._handle_image,
@@ -728,6 +959,7 @@ class MicroscopeServer():
             'move_stage_goto': self._handle_move_stage_goto,
             'get_mag': self._handle_get_mag,
             'get_stage_pos': self._handle_get_stage_pos,
+            'wait_stage_settled': self._handle_wait_stage_settled,
             'get_camera_length': self._handle_get_camera_length,
             'get_camera_length_index': self._handle_get_camera_length_index,
             'get_defocus': self._handle_get_defocus,
@@ -746,6 +978,7 @@ class MicroscopeServer():
             'get_stem_rotation': self._handle_get_stem_rotation,
             'set_stem_rotation': self._handle_set_stem_rotation,
             'get_metadata': self._handle_get_metadata,
+            'get_state': self._handle_get_state,
             'get_beam_tilt': self._handle_get_beam_tilt,
             'set_beam_tilt': self._handle_set_beam_tilt,
             'get_diffraction_shift': self._handle_get_diffraction_shift,
@@ -771,7 +1004,7 @@ class MicroscopeServer():
         while True:
             try:
                 data = serverSocket.recv()
-                self.d = pickle.loads(data)
+                self.d = load_request(data)
                 instruction = self.d['type']
                 self.logger.info('Received command: {}'.format(instruction))
                 self.logger.debug('Command data: {}'.format(self.d))
@@ -801,7 +1034,7 @@ class MicroscopeServer():
                            'reply_data': reply_data,
                            'error': error}
 
-                serverSocket.send(pickle.dumps(reply_d))
+                send_pickled(serverSocket, reply_d)
 
             except KeyboardInterrupt:
                 self.logger.info('Server shutting down due to keyboard interrupt')
@@ -815,15 +1048,17 @@ class MicroscopeServer():
                     reply_d = {'reply_message': 'server error',
                                'reply_data': None,
                                'error': str(e)}
-                    serverSocket.send(pickle.dumps(reply_d))
+                    send_pickled(serverSocket, reply_d)
                 except:
                     self.logger.critical('Failed to send error response to client')
                     pass
 
     # Command handler methods
     def _handle_ping(self):
-        """Handle ping command"""
-        return 'pinged', None
+        """Handle ping command. The reply lists the request encodings
+        this server accepts."""
+        formats = ['pickle', 'msgpack'] if msgpack is not None else ['pickle']
+        return 'pinged', formats
 
     def _handle_c1a1(self):
         """Handle c1a1 measurement"""
@@ -837,6 +1072,10 @@ class MicroscopeServer():
         """Handle acquire image with aberrations"""
         return 'ac', self.acquire_image_with_aberrations()
 
+    def _handle_ac_batch(self):
+        """Handle acquire images with several sets of aberrations"""
+        return 'ac batch', self.acquire_image_batch(self.d['ab_values_list'])
+
     def _handle_ab_only(self):
         """Handle aberrations change only"""
         reply_data = self.abChange(
@@ -850,6 +1089,7 @@ class MicroscopeServer():
 
     def _handle_ref(self):
         """Handle reference image acquisition"""
+        self._ref_fft_cache.clear()
         self.refImage, _, _, _ = self.microscope.microscope_acquire_image(
             self.d['dwell'],
             self.d['shape']
@@ -863,8 +1103,24 @@ class MicroscopeServer():
             self.d['shape'],
             self.d['offset']
         )
+        if self.d.get('shm') and shared_memory is not None:
+            reply_data = (self._share_array(reply_data[0]),) + tuple(reply_data[1:])
         return 'image acquired', reply_data
 
+    def _share_array(self, arr):
+        """ Copy arr into shared memory and return the name, shape and
+        dtype a client on this PC needs to read it. The block is reused
+        while it is large enough and stays open until the next call so the
+        client can copy the array out after receiving the reply."""
+        arr = np.ascontiguousarray(arr)
+        if self._shm is None or self._shm.size < arr.nbytes:
+            if self._shm is not None:
+                self._shm.close()
+                self._shm.unlink()
+            self._shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, arr.dtype, buffer=self._shm.buf)[:] = arr
+        return {'shm': self._shm.name, 'shape': arr.shape, 'dtype': arr.dtype.str}
+
     def _handle_move_stage(self):
         """Handle stage movement by delta"""
         reply_data = self.microscope.move_stage_delta(
@@ -895,6 +1151,11 @@ class MicroscopeServer():
         """Handle get stage position"""
         return 'pos obtained', self.microscope.get_stage_pos()
 
+    def _handle_wait_stage_settled(self):
+        """Handle waiting for the stage to stop moving"""
+        settled = self.microscope.wait_stage_settled(self.d.get('timeout', 2.0))
+        return 'stage settled' if settled else 'stage settle timed out', settled
+
     def _handle_get_camera_length(self):
         """Handle get camera length"""
         return 'camera length obtained', self.microscope.get_camera_length()
@@ -975,6 +1236,10 @@ class MicroscopeServer():
         """Handle get metadata"""
         return 'get metadata', self.microscope.get_metadata()
 
+    def _handle_get_state(self):
+        """Handle get state"""
+        return 'get state', self.microscope.get_state()
+
     def _handle_get_beam_tilt(self):
         """Handle get beam tilt"""
         return self.microscope.get_beam_tilt(), None
@@ -1060,34 +1325,13 @@ class MicroscopeServer():
             Value (in m) by which to shift the beam in y to compensate for aberration correction.
         '''
         
-        # shift scaling factors (ssf, pixels/nm)
-        ssf_dict = {
-                    'C1': (0, 0),
-                    'A1_x': (0, 0),
-                    'A1_y': (0, 0),
-                    'B2_x': (2/400, 0/400),
-                    'B2_y': (3/400, -1/400),
-                    'A2_x': (-5/400, -1/400),
-                    'A2_y': (-7/400, -7/400),
-                    'C3': (0, 0),
-                    'A3_x': (-16/400, -4/400),
-                    'A3_y': (2/400, -24/400),
-                    'S3_x': (5/1000, 1/1000),
-                    'S3_y': (0/1000, 5/1000),
-                    }
-        
         We_x_ssf = 21/10 # only has x-component
         We_y_ssf = -21/10 # only has y-component
         
-        ab_list = list(ab_values.keys())
-        shifts = np.zeros((len(ab_list), 2))
-        
-        for i, ab in enumerate(ab_list):
-            shifts[i,0] = ab_values[ab]*ssf_dict[ab][0]
-            shifts[i,1] = ab_values[ab]*ssf_dict[ab][1]
-        
-        shift_x = np.sum(shifts[:,0])
-        shift_y = np.sum(shifts[:,1])
+        # Aberrations without a scaling factor raise a KeyError as before
+        idx = [self._SSF_INDEX[ab] for ab in ab_values]
+        vals = np.fromiter(ab_values.values(), dtype=np.float64, count=len(idx))
+        shift_x, shift_y = np.dot(vals, self._SSF_MATRIX[idx])
         
         comp_x = -shift_x/We_x_ssf
         comp_y = -shift_y/We_y_ssf
@@ -1111,11 +1355,15 @@ class MicroscopeServer():
             Pooled image
         '''
         
-        b = block_size[0]
-        s = image.shape[0]//b
-        return image.reshape((s, b, s, b)).mean(axis=3).mean(axis=1)
+        b0, b1 = block_size[0], block_size[1]
+        s0 = image.shape[0]//b0
+        s1 = image.shape[1]//b1
+        # Reduce both block axes in one pass. The contiguous copy is only
+        # made for strided input so the reshape is a view.
+        image = np.ascontiguousarray(image)
+        return image.reshape((s0, b0, s1, b1)).mean(axis=(1, 3))
 
-    def correlate_func(self, im0, im1):
+    def correlate_func(self, im0, im1, center=True):
         '''
         Cross-correlate two images
         
@@ -1125,23 +1373,79 @@ class MicroscopeServer():
             1st image
         im1 : array
             2nd image
+        center : bool
+            If im1 is smaller than im0, it is treated as centered in im0. If
+            False, it is treated as padded at the end, and zero offset is at
+            im0.shape//2 - im1.shape//2 with no copy to undo it.
             
         Returns
         -------
-        Cross-correlation value
+        Cross-correlation value. This is not fftshifted so zero offset is
+        at index (0, 0).
         '''
 
-        p0 = np.zeros((im0.shape[0], im0.shape[1]))
-        p1 = np.zeros((im0.shape[0], im0.shape[1]))
-        p1[p1.shape[0]//2-im1.shape[0]//2:p1.shape[0]//2-im1.shape[0]//2 + im1.shape[0],
-           p1.shape[1]//2-im1.shape[1]//2:p1.shape[1]//2-im1.shape[1]//2 + im1.shape[1]] = im1
-        f0 = np.fft.fft2(im0)
-        f1 = np.fft.fft2(p1)
-        f0 *= np.conj(f1)
-        c = np.fft.ifft2(f0)
-        return np.fft.fftshift(c.real)
-
-    def corr_cutout(self, cur_image, ref_image=None, brm=1):
+        # Single precision is plenty for locating the correlation peak and
+        # halves the memory used by the transforms
+        im0 = np.ascontiguousarray(im0, dtype=np.float32)
+        im1 = np.ascontiguousarray(im1, dtype=np.float32)
+        s = im0.shape
+        # Real transforms since both images are real. The images are not
+        # padded since the offsets in corr_cutout assume a circular
+        # correlation the size of im0.
+        f0 = _fft.rfft2(im0, **_FFT_KWARGS)
+        if im1.shape == s:
+            f1 = _fft.rfft2(im1, **_FFT_KWARGS)
+            # f1 is a temporary so it is conjugated in place
+            f0 *= np.conj(f1, out=f1)
+            return _fft.irfft2(f0, s=s, **_FFT_KWARGS)
+        # A smaller im1 is zero padded by the 1D transforms: the rows of im1
+        # first and then the columns of the result. This skips transforming
+        # the zero rows. Padding at the start rather than centering im1
+        # moves the correlation by the centering offset.
+        f1 = _fft.rfft(im1, n=s[1], axis=1, **_FFT_KWARGS)
+        f1 = _fft.fft(f1, n=s[0], axis=0, **_FFT_KWARGS)
+        f0 *= np.conj(f1, out=f1)
+        c = _fft.irfft2(f0, s=s, **_FFT_KWARGS)
+        if not center:
+            return c
+        return np.roll(c, (im1.shape[0]//2 - s[0]//2, im1.shape[1]//2 - s[1]//2), axis=(0, 1))
+
+    def _ref_fft(self, ref_image, brm):
+        '''
+        The binned reference image and the conjugate of its real FFT with
+        the DC term removed. These are cached since the same reference is used for
+        every image in a tuning run. The cache holds the reference image
+        itself so its id cannot be reused by a new array while the entry
+        exists.
+        
+        Parameters
+        ----------
+        ref_image : array
+            Reference image
+        brm : int
+            Block reduce (binning) factor
+            
+        Returns
+        -------
+        refIm : array
+            The binned reference image
+        ref_fft : array
+            Conjugate of the real FFT of refIm with ref_fft[0, 0] = 0
+        '''
+        key = (id(ref_image), brm, ref_image.shape)
+        entry = self._ref_fft_cache.get(key)
+        if entry is not None and entry[0] is ref_image:
+            return entry[1], entry[2]
+        refIm = self.block_reduce_mean(ref_image, (brm,brm))
+        ref_fft = _fft.rfft2(refIm.astype(np.float32), **_FFT_KWARGS)
+        np.conj(ref_fft, out=ref_fft)
+        ref_fft[0, 0] = 0 # same as subtracting the mean from refIm
+        if len(self._ref_fft_cache) >= 4:
+            self._ref_fft_cache.clear()
+        self._ref_fft_cache[key] = (ref_image, refIm, ref_fft)
+        return refIm, ref_fft
+
+    def corr_cutout(self, cur_image, ref_image=None, brm=1, max_drift=None):
         '''
         Cross-correlate two images and cut out the overlapping regions
         
@@ -1153,26 +1457,58 @@ class MicroscopeServer():
             Reference image
         brm : int
             Block reduce (binning) factor for use in cross-correlation
+        max_drift : int, optional
+            Largest drift in binned pixels to search for the correlation
+            peak. Defaults to the max_drift_px setting of the command or 64.
             
         Returns
         -------
         cutout : array
-            Region of cur_image that overlaps with ref_image
+            Region of cur_image that overlaps with ref_image. This is a view
+            into cur_image, not a copy.
         '''
         if ref_image is None:
             ref_image = self.refImage
         
-        refIm = self.block_reduce_mean(ref_image, (brm,brm))
+        refIm, ref_fft = self._ref_fft(ref_image, brm)
         curIm = self.block_reduce_mean(cur_image, (brm,brm))
         
-        corr = self.correlate_func(curIm-curIm.mean(), refIm-refIm.mean())
-        corr_arg = np.array(np.unravel_index(np.argmax(corr), corr.shape))
-        offset = (corr_arg-np.array(refIm.shape)/2)
+        if curIm.shape == refIm.shape:
+            # Zeroing the DC term of the transform removes the mean without
+            # another pass over the image
+            f0 = _fft.rfft2(curIm.astype(np.float32), **_FFT_KWARGS)
+            f0[0, 0] = 0
+            f0 *= ref_fft
+            corr = _fft.irfft2(f0, s=curIm.shape, **_FFT_KWARGS)
+            origin = np.zeros(2, dtype=int)
+        else:
+            # The uncentered correlation has zero offset at origin
+            corr = self.correlate_func(curIm-curIm.mean(), refIm-refIm.mean(), center=False)
+            origin = np.array(curIm.shape)//2 - np.array(refIm.shape)//2
+        # Find the peak in the unshifted correlation and move its index to
+        # where fftshift would have put it. Drift between images is small
+        # so only the offsets up to max_drift, found at the corners of the
+        # unshifted correlation, are searched.
+        if max_drift is None:
+            max_drift = (self.d or {}).get('max_drift_px', 64)
+        shape = np.array(corr.shape)
+        if 2*max_drift + 1 < min(corr.shape):
+            rows = (np.arange(-max_drift, max_drift+1) + origin[0]) % shape[0]
+            cols = (np.arange(-max_drift, max_drift+1) + origin[1]) % shape[1]
+            sub = corr[np.ix_(rows, cols)]
+            corr_arg = np.array(np.unravel_index(np.argmax(sub), sub.shape))
+            corr_arg = corr_arg - max_drift + shape//2
+        else:
+            corr_arg = np.array(np.unravel_index(np.argmax(corr), corr.shape))
+            corr_arg = (corr_arg - origin + shape//2) % shape
+        H, W = refIm.shape
+        ox = int(corr_arg[0]) - H//2
+        oy = int(corr_arg[1]) - W//2
         
-        x_start = int(np.array(refIm.shape[0])/4+offset[0])*brm
-        x_end = int(3*np.array(refIm.shape[0])/4+offset[0])*brm
-        y_start = int(np.array(refIm.shape[1])/4+offset[1])*brm
-        y_end = int(3*np.array(refIm.shape[1])/4+offset[1])*brm
+        x_start = (H//4 + ox)*brm
+        x_end = (3*H//4 + ox)*brm
+        y_start = (W//4 + oy)*brm
+        y_end = (3*W//4 + oy)*brm
         
         cutout = cur_image[x_start:x_end,y_start:y_end]
         
@@ -1201,47 +1537,86 @@ class MicroscopeServer():
         '''
         if not type(metric) is str:
             raise TypeError('Metric is not a string')
-        if metric == 'df_slice':
-            y = np.sum(image_data, axis=np.argmin(image_data.shape))
-            fft_im = np.fft.fft(y)
-            fft_abs = np.abs(fft_im)
-            qval = np.sum(fft_abs[1:len(y)])/fft_abs[0]
-        elif metric == 'std':
-            qval = np.std(image_data)
-        elif metric == 'normstd':
-            qval = np.std(image_data)/np.mean(image_data)
-        elif metric == 'var':
-            qval = np.var(image_data)
-        elif metric == 'normvar':
-            qval = np.var(image_data)/(np.mean(image_data)**2)
-        elif metric == 'roughness':
-            #Calculate the Fourier coordinates with
-            kx = np.fft.fftfreq(image_data.shape[0])
-            ky = np.fft.fftfreq(image_data.shape[1])
-            kr2 = kx[:,None]**2 + ky[None,:]**2
-            #(or use np.outer for the outer product)
-            
-            #And an optional window function
-            wx = np.hanning(image_data.shape[0])
-            wy = np.hanning(image_data.shape[1])
-            w = wx[:,None] * wy[None,:]
-            #(or use np.outer for the outer product)
+        handler = self._metric_handlers.get(metric)
+        if handler is None:
+            # includes varlaplace which is not implemented
+            return None
+        return handler(image_data)
+
+    def _metric_df_slice(self, image_data):
+        y = np.sum(image_data, axis=np.argmin(image_data.shape)).astype(np.float32)
+        # y is real so the negative frequencies mirror the positive
+        # ones. Count each of them twice except the Nyquist term.
+        fft_abs = np.abs(_fft.rfft(y, **_FFT_KWARGS))
+        ac = 2*(fft_abs.sum() - fft_abs[0])
+        if len(y) % 2 == 0:
+            ac -= fft_abs[-1]
+        return ac/fft_abs[0]
+
+    def _metric_normstd(self, image_data):
+        mean, var = _mean_var(image_data)
+        return np.sqrt(var)/mean
+
+    def _metric_normvar(self, image_data):
+        mean, var = _mean_var(image_data)
+        return var/(mean**2)
+
+    def _metric_roughness(self, image_data):
+        w = self._roughness_terms(image_data.shape)[0]
+        F = _fft.fft2(np.multiply(image_data, w, dtype=np.float32), **_FFT_KWARGS)
+        return self._metric_from_fft(F, 'roughness')
+              
+    def _roughness_terms(self, shape):
+        '''
+        The window and squared Fourier coordinates for the roughness metric.
+        These only depend on the image shape, which is fixed for a tuning
+        run, so they are cached.
+        
+        Parameters
+        ----------
+        shape : tuple
+            Image shape
             
-            #Then calculate the FFT intensity:
-            G2 = np.abs(np.fft.fft2(image_data * w))**2
-            #or
-            #G2 = np.abs(np.fft.fft2(image_data))**2
+        Returns
+        -------
+        w : array
+            Hanning window applied to the image before the FFT
+        kx2, ky2 : array
+            Squared spatial frequencies along each axis
+        '''
+        if shape not in self._roughness_cache:
+            kx2 = np.fft.fftfreq(shape[0])**2
+            ky2 = np.fft.fftfreq(shape[1])**2
+            w = np.outer(np.hanning(shape[0]).astype(np.float32),
+                         np.hanning(shape[1]).astype(np.float32))
+            for arr in (w, kx2, ky2):
+                arr.flags.writeable = False
+            self._roughness_cache[shape] = (w, kx2, ky2)
+        return self._roughness_cache[shape]
+
+    def _metric_from_fft(self, F, metric):
+        '''
+        Calculate a Fourier space quality metric from the FFT of the
+        windowed image. Only roughness is computed this way.
+        
+        Parameters
+        ----------
+        F : array
+            fft2 of the image multiplied by the window from _roughness_terms
+        metric : str
+            Quality metric ('roughness')
             
-            #And finally image roughness r2 using:
-            r2 = np.sum(G2 * kr2 ) / np.sum(G2)
-            qval = r2
-        elif metric == 'varlaplace':
-            #qval = np.var(laplace(image_data))
-            qval = None
-        else:
-            qval = None
-        return qval
-              
+        Returns
+        -------
+        qval : float
+            Value of quality metric
+        '''
+        if metric == 'roughness':
+            # Image roughness r2 = sum(|FFT|**2 * k**2) / sum(|FFT|**2)
+            _, kx2, ky2 = self._roughness_terms(F.shape)
+            return _roughness_reduce(F, kx2, ky2)
+        raise ValueError('{} is not a Fourier space metric'.format(metric))
+
     def acquire_image_with_aberrations(self):
         '''
         Takes image with a given aberration (information contained in self.d dictionary) and returns the image
@@ -1277,6 +1652,36 @@ class MicroscopeServer():
             bscomp = self.d['bscomp']
             ccorr = self.d['ccorr']
         
+        image, calX, calY, unitName = self._acquire_aberrated_image(
+            ab_values, ab_select, dwell_time, shape, offset, C1_defocus_flag, bscomp, ccorr)
+        
+        qval = self.metric_func(image, metric)
+        im_dict = {'image': image,
+                   'calX': calX,
+                   'calY': calY,
+                   'unitName': unitName}
+        
+        if return_images:
+            return qval, im_dict
+        else:
+            return qval
+    
+    def _acquire_aberrated_image(self, ab_values, ab_select, dwell_time, shape, offset,
+                                 C1_defocus_flag, bscomp, ccorr):
+        '''
+        Change the aberrations, take an image and undo the change. The image
+        is cut out to the region overlapping the reference if ccorr is set.
+        See acquire_image_with_aberrations for the parameters.
+        
+        Returns
+        -------
+        image : array
+            The image or the cutout
+        calX, calY : float
+            Pixel calibrations
+        unitName : str
+            Unit of the calibrations
+        '''
         self.abChange(ab_values, ab_select, C1_defocus_flag, bscomp=bscomp)
         image_data, calX, calY, unitName = self.microscope.microscope_acquire_image(dwell_time, shape, offset)
         self.abChange(ab_values, ab_select, C1_defocus_flag, undo=True, bscomp=bscomp)
@@ -1288,18 +1693,58 @@ class MicroscopeServer():
             print('Cross-correlation not yet implemented for non-square images')
         else:
             image = image_data
+        return image, calX, calY, unitName
+
+    def acquire_image_batch(self, ab_values_list):
+        '''
+        Takes one image for each set of aberrations in ab_values_list and
+        returns their quality metrics. The other settings are read from the
+        self.d dictionary as in acquire_image_with_aberrations.
         
-        qval = self.metric_func(image, metric)
-        im_dict = {'image': image,
-                   'calX': calX,
-                   'calY': calY,
-                   'unitName': unitName}
+        The roughness metric is calculated with one FFT over the stack of
+        images rather than one FFT per image.
         
-        if return_images:
-            return qval, im_dict
+        Parameters
+        ----------
+        ab_values_list : list of dict
+            Aberration names and magnitudes for each image.
+            
+        Returns
+        -------
+        qvals : list of float
+            Quality metric of each image.
+        im_dicts : list of dict
+            Only returned if return_images is set. Dictionaries containing the
+            image, calX and calY, unit name.
+        '''
+        d = self.d
+        images = []
+        im_dicts = []
+        for ab_values in ab_values_list:
+            image, calX, calY, unitName = self._acquire_aberrated_image(
+                ab_values, d['ab_select'], d['dwell'], d['shape'], d['offset'],
+                d['C1_defocus_flag'], d['bscomp'], d['ccorr'])
+            images.append(image)
+            im_dicts.append({'image': image,
+                             'calX': calX,
+                             'calY': calY,
+                             'unitName': unitName})
+        
+        metric = d['metric']
+        shapes = set(im.shape for im in images)
+        if metric == 'roughness' and len(shapes) == 1:
+            w = self._roughness_terms(shapes.pop())[0]
+            stack = np.multiply(np.stack(images), w, dtype=np.float32)
+            F = _fft.fft2(stack, axes=(-2, -1), **_FFT_KWARGS)
+            qvals = [self._metric_from_fft(f, metric) for f in F]
         else:
-            return qval
-    
+            qvals = [self.metric_func(im, metric) for im in images]
+        
+        if d['return_images']:
+            return qvals, im_dicts
+        else:
+            return qvals
+
     def c1a1_measurement(self):
         '''
         Takes a defocus (C1) and 2-fold astigmatism (A1) measurement with the beam tilted.
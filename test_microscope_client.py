@@ -18,6 +18,26 @@ import argparse
 import time
 from datetime import datetime
 
+import numpy as np
+
+# Requests are sent with msgpack when it is installed and the server
+# accepts it. Replies stay pickled since they can hold PIL images.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _join_arrays(data, frames):
+    """Wrap the frames that a Python 3.4 server sends arrays in without
+    copying them. The pickled reply refers to each by a header dict."""
+    if isinstance(data, dict) and 'ndarray' in data:
+        buf = frames[data['ndarray']].buffer
+        return np.frombuffer(buf, dtype=np.dtype(data['dtype'])).reshape(data['shape'])
+    if isinstance(data, tuple):
+        return tuple(_join_arrays(v, frames) for v in data)
+    return data
+
 
 class MicroscopeTestClient():
     def __init__(self, host='localhost', port=7001):
@@ -38,18 +58,34 @@ class MicroscopeTestClient():
         self.failed = 0
         self.errors = []
 
+        # Set by the ping test when the server accepts msgpack requests
+        self.msgpack = False
+
+    def _encode(self, command_dict):
+        """msgpack the request if the server accepts it, otherwise pickle
+        it with protocol 4 for the Python 3.4 server."""
+        if self.msgpack:
+            return msgpack.packb(command_dict, use_bin_type=True)
+        return pickle.dumps(command_dict, protocol=4)
+
     def send_command(self, command_dict):
         """Send command to server and return response"""
         try:
-            self.socket.send(pickle.dumps(command_dict))
-            response = self.socket.recv()
-            return pickle.loads(response)
+            self.socket.send(self._encode(command_dict))
+            frames = self.socket.recv_multipart(copy=False)
+            header = frames[0].buffer
+            if len(frames) > 1 and header[1] < 5: # the pickle protocol
+                reply = pickle.loads(header)
+                reply['reply_data'] = _join_arrays(reply['reply_data'], frames)
+                return reply
+            return pickle.loads(header, buffers=[f.buffer for f in frames[1:]])
         except Exception as e:
             print(f"ERROR: Communication failure: {str(e)}")
             return None
 
     def test_command(self, name, command_dict, expect_data=None):
-        """Test a single command and report results"""
+        """Test a single command and report results. Returns the
+        response if the command passed and False otherwise."""
         print(f"\nTesting: {name}")
         print(f"  Command: {command_dict['type']}")
 
@@ -78,7 +114,7 @@ class MicroscopeTestClient():
             print(f"  Data: {response['reply_data']}")
 
         self.passed += 1
-        return True
+        return response
 
     def run_all_tests(self):
         """Run all test commands"""
@@ -90,10 +126,14 @@ class MicroscopeTestClient():
         print("\n" + "="*60)
         print("BASIC CONNECTIVITY TESTS")
         print("="*60)
-        self.test_command(
+        response = self.test_command(
             "Ping",
-            {'type': 'ping'}
+            {'type': 'ping'},
+            expect_data=True
         )
+        if response:
+            self.msgpack = msgpack is not None and 'msgpack' in (response['reply_data'] or ())
+            print(f"  Request encoding: {'msgpack' if self.msgpack else 'pickle'}")
 
         # 2. Test getter commands (safe, read-only)
         print("\n" + "="*60)